@@ -0,0 +1,414 @@
+#Нагрузочный замер бота без сети: настоящие обработчики refinderbot против поддельного Bot API и поддельного yt-dlp
+#запуск: python bench_bot.py --users 20 --limit 300
+#нагрузка - запросы из search_history и ссылки из download_history (--db), без истории - придуманные запросы
+#бот работает во временной папке со своими базами, настоящие базы только читаются
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import queue
+import random
+import re
+import resource
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import types
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import parse_qs, urlparse
+
+DATABASE_FILE = 'telemusic.db'  #откуда брать нагрузку, та же база, что и у бота
+BENCH_USER_ID = 1000  #ID первого виртуального пользователя, дальше по порядку
+RESPONSE_TIMEOUT = 120  #сколько секунд ждать ответа бота на одно действие
+
+
+##ПОДДЕЛЬНЫЙ YT-DLP
+#каталог из catalog видео: разные запросы находят одни и те же треки, как в жизни
+def fake_video_id(catalog, *key):
+    number = int(hashlib.md5(repr(key).encode('utf-8')).hexdigest(), 16) % catalog
+    return hashlib.md5(str(number).encode('utf-8')).hexdigest()[:11]
+
+def fake_duration(video_id):
+    return 60 + int(hashlib.md5(video_id.encode('utf-8')).hexdigest(), 16) % 400
+
+#вместо yt_dlp.YoutubeDL: задержки и размеры файлов задаются атрибутами класса до запуска бота
+class FakeYoutubeDL:
+    search_latency = 0.3  #секунд на страницу поиска
+    probe_latency = 0.2  #секунд на разбор страницы видео
+    download_rate = 4 * 1024 * 1024  #байт в секунду
+    file_size = 4 * 1024 * 1024  #размер скачанного аудио
+    acodec = 'mp4a.40.2'  #'mp4a...' - перепаковка, 'opus' - перекодирование в mp3
+    catalog = 1000
+
+    def __init__(self, params=None):
+        self.params = params or {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def extract_info(self, url, download=False):
+        if not url.startswith('http') and self.params.get('default_search'):
+            url = f"{self.params['default_search']}:{url}"
+        match = re.match(r'ytsearch(\d+):(.*)', url)
+        if match:
+            time.sleep(self.search_latency)
+            count, keywords = int(match.group(1)), match.group(2)
+            entries = []
+            for i in range(count):
+                video_id = fake_video_id(self.catalog, keywords, i)
+                entries.append({'id': video_id, 'title': f'{keywords} {i + 1}', 'duration': fake_duration(video_id),
+                                'webpage_url': f'https://www.youtube.com/watch?v={video_id}'})
+            if not self.params.get('extract_flat'):
+                time.sleep(self.probe_latency * count)  # Без extract_flat разбирается страница каждого видео
+            return {'entries': entries}
+        time.sleep(self.probe_latency)
+        video_id = re.search(r'v=([\w-]{11})', url).group(1)
+        info = {
+            'id': video_id,
+            'title': f'Track {video_id}',
+            'duration': fake_duration(video_id),
+            'ext': 'm4a' if self.acodec.startswith('mp4a') else 'webm',
+            'acodec': self.acodec,
+            'formats': [{'format_id': '140', 'ext': 'm4a', 'acodec': self.acodec, 'abr': 128, 'vcodec': 'none'}],
+        }
+        return self.process_ie_result(info, download)
+
+    def sanitize_info(self, info):
+        return info
+
+    def process_ie_result(self, info, download=True):
+        if download:
+            time.sleep(self.file_size / self.download_rate)
+            with open(self.prepare_filename(info), 'wb') as file:
+                file.write(b'\0' * self.file_size)
+        return info
+
+    def prepare_filename(self, info):
+        return self.params['outtmpl'] % info
+
+#вместо ffmpeg: копирует вход в выход, delay - сколько секунд изображать работу
+def write_fake_ffmpeg(directory, delay):
+    path = os.path.join(directory, 'ffmpeg')
+    with open(path, 'w') as file:
+        file.write(f'''#!{sys.executable}
+import shutil, sys, time
+args = sys.argv[1:]
+time.sleep({delay})
+shutil.copyfile(args[args.index('-i') + 1], args[-1])
+''')
+    os.chmod(path, 0o755)
+    return path
+
+
+##ПОДДЕЛЬНЫЙ BOT API
+#getUpdates отдает подложенные обновления, остальные методы отвечают успехом и передают вызов виртуальным пользователям
+class FakeBotAPI:
+    def __init__(self):
+        self.updates = []
+        self.updates_ready = threading.Condition()
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.inboxes = {}  #ID чата -> очередь (метод, параметры)
+        self.calls = {}  #метод -> сколько раз вызван
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.make_handler())
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def push_update(self, kind, item):
+        with self.updates_ready:
+            self.updates.append({'update_id': next(self.update_ids), kind: item})
+            self.updates_ready.notify_all()
+
+    def inbox(self, chat_id):
+        with self.lock:
+            return self.inboxes.setdefault(chat_id, queue.Queue())
+
+    def get_updates(self, params):
+        offset = int(params.get('offset', 0))
+        deadline = time.monotonic() + min(float(params.get('timeout', 0)), 1)
+        with self.updates_ready:
+            self.updates = [update for update in self.updates if update['update_id'] >= offset]
+            while not self.updates and time.monotonic() < deadline:
+                self.updates_ready.wait(deadline - time.monotonic())
+            return list(self.updates)
+
+    def message(self, params, **extra):
+        chat = {'id': int(params.get('chat_id', 0)), 'type': 'private'}
+        return dict({'message_id': next(self.message_ids), 'date': int(time.time()), 'chat': chat}, **extra)
+
+    def call(self, method, params):
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+        if method == 'getUpdates':
+            return self.get_updates(params)
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'bench', 'username': 'bench_bot'}
+        if 'chat_id' in params:
+            self.inbox(int(params['chat_id'])).put((method, params))
+        if method == 'sendMessage':
+            return self.message(params, text=params.get('text', ''))
+        if method == 'sendAudio':
+            audio = params.get('audio') or hashlib.md5(os.urandom(8)).hexdigest()  # Загрузка файла - новый file_id
+            return self.message(params, audio={'file_id': audio, 'file_unique_id': audio[:16], 'duration': 0})
+        if method == 'editMessageText':
+            return self.message(params, text=params.get('text', ''))
+        return True  # answerCallbackQuery, deleteMessage, deleteWebhook и т.п.
+
+    def make_handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                request = urlparse(self.path)
+                params = {name: values[0] for name, values in parse_qs(request.query).items()}
+                self.rfile.read(int(self.headers.get('Content-Length') or 0))  # Файл sendAudio читаем, но не храним
+                method = request.path.rsplit('/', 1)[-1]
+                body = json.dumps({'ok': True, 'result': api.call(method, params)}).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            do_GET = do_POST
+
+            def log_message(self, format, *args):
+                pass
+        return Handler
+
+
+##НАГРУЗКА
+#(вид, текст): 'search' - запрос, 'link' - прямая ссылка
+def load_workload(db_path, limit, catalog):
+    items = []
+    if os.path.exists(db_path):
+        conn = sqlite3.connect(db_path)
+        items += [('search', keywords) for (keywords,) in conn.execute(
+            'SELECT keywords FROM search_history ORDER BY last_call LIMIT ?', (limit,))]
+        items += [('link', url) for (url,) in conn.execute(
+            'SELECT video_url FROM download_history ORDER BY id LIMIT ?', (limit,))]
+        conn.close()
+    if not items:  # Истории нет: популярные запросы повторяются чаще (закон Ципфа)
+        rng = random.Random(1)
+        queries = [f'artist {n} song {n * 7 % 13}' for n in range(max(limit // 3, 1))]
+        items = [('search', rng.choices(queries, weights=[1 / (n + 1) for n in range(len(queries))])[0])
+                 for _ in range(limit)]
+        items += [('link', f'https://www.youtube.com/watch?v={fake_video_id(catalog, "link", n)}')
+                  for n in range(limit // 5)]
+    random.Random(0).shuffle(items)
+    return items[:limit]
+
+def user_json(user_id):
+    return {'id': user_id, 'is_bot': False, 'first_name': 'bench', 'username': f'bench{user_id}'}
+
+def send_text(api, user_id, text):
+    api.push_update('message', {
+        'message_id': next(api.message_ids), 'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private'}, 'from': user_json(user_id), 'text': text,
+        'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}] if text.startswith('/') else []})
+
+def send_click(api, user_id, data):
+    api.push_update('callback_query', {
+        'id': str(next(api.message_ids)), 'from': user_json(user_id), 'chat_instance': str(user_id), 'data': data,
+        'message': {'message_id': next(api.message_ids), 'date': int(time.time()),
+                    'chat': {'id': user_id, 'type': 'private'}, 'text': 'Выберите трек для скачивания:'}})
+
+#ждем первого ответа, для которого done(метод, параметры) истинно
+def wait_reply(inbox, done):
+    deadline = time.monotonic() + RESPONSE_TIMEOUT
+    while True:
+        try:
+            method, params = inbox.get(timeout=max(deadline - time.monotonic(), 0))
+        except queue.Empty:
+            return 'timeout', None
+        result = done(method, params)
+        if result:
+            return result, params
+
+class VirtualUsers:
+    def __init__(self, api, bot_module, click_rate):
+        self.api = api
+        self.bot_module = bot_module
+        self.click_rate = click_rate
+        self.latencies = {}  #вид действия -> секунды
+        self.outcomes = {}  #(вид действия, итог) -> сколько раз
+        self.lock = threading.Lock()
+
+    def record(self, kind, outcome, seconds):
+        with self.lock:
+            self.outcomes[(kind, outcome)] = self.outcomes.get((kind, outcome), 0) + 1
+            if outcome == 'ok':
+                self.latencies.setdefault(kind, []).append(seconds)
+
+    def search_done(self, method, params):
+        if method == 'sendMessage':
+            return 'ok' if 'reply_markup' in params else 'no_keyboard'  # Ничего не найдено или лимит
+        return None
+
+    #трек в чате - успех, окончательный текст в статусе или ответе на кнопку - отказ
+    def download_done(self, method, params):
+        statuses = self.bot_module.STATUS_TEXTS.values()
+        if method == 'sendAudio':
+            return 'ok'
+        if method in ('sendMessage', 'editMessageText') and params.get('text') not in statuses:
+            return 'failed'
+        if method == 'answerCallbackQuery' and params.get('text'):
+            return 'failed'
+        return None
+
+    def run(self, user_id, items):
+        inbox = self.api.inbox(user_id)
+        rng = random.Random(user_id)
+        send_text(self.api, user_id, '/start')
+        wait_reply(inbox, lambda method, params: method == 'sendMessage')
+        for kind, value in items:
+            started = time.monotonic()
+            if kind == 'link':
+                send_text(self.api, user_id, value)
+                outcome, _ = wait_reply(inbox, self.download_done)
+                self.record('link', outcome, time.monotonic() - started)
+                continue
+            send_text(self.api, user_id, value)
+            outcome, params = wait_reply(inbox, self.search_done)
+            self.record('search', outcome, time.monotonic() - started)
+            if outcome != 'ok' or rng.random() >= self.click_rate:
+                continue
+            buttons = [button['callback_data'] for row in json.loads(params['reply_markup'])['inline_keyboard']
+                       for button in row if button['callback_data'].startswith('d:')]
+            #верхние результаты выбирают чаще
+            data = rng.choices(buttons, weights=[1 / (n + 1) for n in range(len(buttons))])[0]
+            started = time.monotonic()
+            send_click(self.api, user_id, data)
+            outcome, _ = wait_reply(inbox, self.download_done)
+            self.record('click', outcome, time.monotonic() - started)
+
+
+##ОТЧЕТ
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+def report(users, bot_module, elapsed, started_rss):
+    actions = sum(users.outcomes.values())
+    print(f'{actions} действий за {elapsed:.1f} с: {actions / elapsed:.1f} в секунду')
+    for kind, latencies in sorted(users.latencies.items()):
+        print(f'{kind}: {len(latencies)} успешно, p50 {percentile(latencies, 0.5):.3f} с, '
+              f'p99 {percentile(latencies, 0.99):.3f} с, макс {max(latencies):.3f} с')
+    failures = {key: count for key, count in users.outcomes.items() if key[1] != 'ok'}
+    if failures:
+        print('Без результата: ' + ', '.join(f'{kind}/{outcome} {count}' for (kind, outcome), count in sorted(failures.items())))
+    _, events, _ = bot_module.stats_snapshot()
+    file_id = events.get('file_id_hit', 0), events.get('file_id_miss', 0)
+    files = events.get('file_cache_hit', 0), events.get('file_cache_miss', 0)
+    print(f'Кэш поиска: {bot_module.search_cache_hit_rate():.0%}, '
+          f'file_id: {file_id[0] / sum(file_id) if sum(file_id) else 0:.0%}, '
+          f'файлы на диске: {files[0] / sum(files) if sum(files) else 0:.0%}')
+    if bot_module.PREFETCH_TOP_K:
+        print(bot_module.prefetch_stats_text())
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss // 1024
+    print(f'Память: бот {started_rss} -> {own} МБ (пик), процессы загрузки до {children} МБ')
+
+def run_broadcast(bot_module):
+    broadcast_id, total = bot_module.broadcast_message('bench')
+    while True:
+        with bot_module.broadcast_lock:
+            run = dict(bot_module.broadcast_runs[broadcast_id])
+        if run['finished']:
+            break
+        time.sleep(0.1)
+    elapsed = run['finished'] - run['started']
+    print(f"Рассылка: {run['sent']} из {total} за {elapsed:.1f} с, {run['sent'] / elapsed if elapsed else 0:.1f} сообщ./с")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Нагрузочный замер бота без YouTube и Telegram')
+    parser.add_argument('--db', default=DATABASE_FILE, help='база, из которой берется нагрузка')
+    parser.add_argument('--limit', type=int, default=200, help='сколько действий воспроизвести')
+    parser.add_argument('--users', type=int, default=10, help='виртуальных пользователей одновременно')
+    parser.add_argument('--click-rate', type=float, default=0.5, help='доля поисков, после которых нажимают на трек')
+    parser.add_argument('--search-ms', type=int, default=300)
+    parser.add_argument('--probe-ms', type=int, default=200)
+    parser.add_argument('--ffmpeg-ms', type=int, default=100)
+    parser.add_argument('--file-kb', type=int, default=4096)
+    parser.add_argument('--rate-kb', type=int, default=4096, help='скорость скачивания, КБ/с')
+    parser.add_argument('--catalog', type=int, default=1000, help='сколько разных видео в поддельном YouTube')
+    parser.add_argument('--transcode', action='store_true', help='отдавать opus, чтобы бот перекодировал в mp3')
+    parser.add_argument('--prefetch', type=int, default=0, help='PREFETCH_TOP_K для замера')
+    parser.add_argument('--limits', action='store_true', help='оставить лимиты пользователей (по умолчанию выключены)')
+    parser.add_argument('--broadcast', action='store_true', help='после нагрузки замерить рассылку всем пользователям')
+    parser.add_argument('--stages', action='store_true', help='вывести время этапов бота (как /stats)')
+    args = parser.parse_args()
+
+    FakeYoutubeDL.search_latency = args.search_ms / 1000
+    FakeYoutubeDL.probe_latency = args.probe_ms / 1000
+    FakeYoutubeDL.file_size = args.file_kb * 1024
+    FakeYoutubeDL.download_rate = args.rate_kb * 1024
+    FakeYoutubeDL.catalog = args.catalog
+    FakeYoutubeDL.acodec = 'opus' if args.transcode else 'mp4a.40.2'
+    items = load_workload(args.db, args.limit, args.catalog)
+    api = FakeBotAPI()
+    workdir = tempfile.mkdtemp(prefix='refinder-bench-')
+
+    # Настройки подставляются до импорта бота, см. REFINDER_SETTINGS в refinderbot.py
+    settings = types.ModuleType('bench_settings')
+    settings.BOT_TOKEN = '123456:bench'
+    settings.BOT_API_URL = api.url
+    settings.ADMIN_USER_ID = '1'
+    settings.DATABASE_FILE = os.path.join(workdir, 'telemusic.db')
+    settings.CACHE_DB_FILE = os.path.join(workdir, 'telegram_bot_cache.db')
+    settings.CACHE_JSON_FILE = os.path.join(workdir, 'telegram_bot_cache.json')
+    settings.DOWNLOAD_DIR = os.path.join(workdir, 'audio') + os.sep
+    settings.YDL_FACTORY = FakeYoutubeDL
+    settings.FFMPEG = write_fake_ffmpeg(workdir, args.ffmpeg_ms / 1000)
+    settings.PREFETCH_TOP_K = args.prefetch
+    settings.LOG_LEVEL = 'WARNING'
+    if not args.limits:
+        settings.USER_RATE_LIMITS = {'search': (10**6, 10**6), 'download': (10**6, 10**6)}
+        settings.USER_JOBS_MAX = 10**6
+    sys.modules[settings.__name__] = settings
+    os.environ['REFINDER_SETTINGS'] = settings.__name__
+    os.makedirs(settings.DOWNLOAD_DIR)
+    import refinderbot
+
+    refinderbot.init_storage()
+    refinderbot.load_audio_store()
+    bot = refinderbot.create_bot()
+    refinderbot.start_db_writer()
+    refinderbot.start_download_workers()
+    threading.Thread(target=bot.polling, kwargs={'non_stop': True, 'interval': 0, 'timeout': 5, 'long_polling_timeout': 1},
+                     daemon=True).start()
+
+    started_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024
+    users = VirtualUsers(api, refinderbot, args.click_rate)
+    threads = [threading.Thread(target=users.run, args=(BENCH_USER_ID + n, items[n::args.users]))
+               for n in range(args.users)]
+    print(f'{len(items)} записей нагрузки, {args.users} пользователей, папка {workdir}')
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    report(users, refinderbot, time.monotonic() - started, started_rss)
+    if args.broadcast:
+        run_broadcast(refinderbot)
+    if args.stages:
+        print(refinderbot.stats_text())
+    print('Вызовы Bot API: ' + ', '.join(f'{method} {count}' for method, count in sorted(api.calls.items())))
+
+    bot.stop_polling()
+    refinderbot.db_flush()
+    refinderbot.download_pool.shutdown(wait=False, cancel_futures=True)
+    shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+#Замер времени до первой клавиатуры: тот же поиск, что у бота (refinderbot.search_music), плюс сборка клавиатуры,
+#и для сравнения старый поиск - полное извлечение ytsearch15 новым YoutubeDL на каждый запрос
+#запуск: python bench_search.py "daft punk one more time" "queen bohemian rhapsody"
+#без аргументов берутся последние запросы из search_history
+#настройки бота - как у бота, в том числе из REFINDER_SETTINGS; без них кэш поиска во временной папке,
+#чтобы первый проход был без кэша, а настоящий кэш не менялся
+#--fake - поддельный YouTube из bench_bot.py (без сети, задержки --search-ms и --probe-ms)
+import argparse
+import os
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+import types
+
+DATABASE_FILE = 'telemusic.db'  #откуда брать запросы, та же база, что и у бота
+QUERIES_FROM_HISTORY = 10  #сколько последних запросов брать из истории
+
+
+def history_queries(db_path, limit=QUERIES_FROM_HISTORY):
+    if not os.path.exists(db_path):
+        return []
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    cursor.execute('SELECT DISTINCT keywords FROM search_history ORDER BY last_call DESC LIMIT ?', (limit,))
+    queries = [row[0] for row in cursor.fetchall()]
+    conn.close()
+    return queries
+
+#как обработчик text: sanitize, поиск (из кэша или YouTube), сессия и первая страница кнопок
+def first_keyboard(refinderbot, query):
+    keywords = refinderbot.sanitize(query)
+    results, fetched = refinderbot.search_music(None, keywords)
+    if results:
+        refinderbot.results_keyboard(refinderbot.new_session(0, keywords, results, fetched))
+
+#как искал бот раньше: новый YoutubeDL на каждый запрос, полное извлечение всех MAX_RESULTS, без кэша
+def legacy_keyboard(refinderbot, query):
+    keywords = refinderbot.sanitize(query)
+    ydl_opts = {
+        'default_search': f'ytsearch{refinderbot.MAX_RESULTS}',
+        'noplaylist': True,
+        'quiet': True
+        }
+    with refinderbot.YDL_FACTORY(ydl_opts) as ydl:
+        info = ydl.extract_info(keywords, download=False)
+    results = [
+        {'title': e.get('title') or 'Unknown Title', 'webpage_url': e['webpage_url'], 'duration': int(e['duration'])}
+        for e in (info or {}).get('entries') or []
+        if e.get('duration') and e['duration'] <= refinderbot.MAX_DURATION
+    ]
+    if results:
+        refinderbot.results_keyboard(refinderbot.new_session(0, keywords, results, refinderbot.MAX_RESULTS))
+
+def measure(refinderbot, queries, search=first_keyboard):
+    timings = []
+    for query in queries:
+        started = time.monotonic()
+        search(refinderbot, query)
+        timings.append(time.monotonic() - started)
+    return timings
+
+def report(name, timings):
+    print(f'{name}: медиана {statistics.median(timings):.2f} с, '
+          f'макс {max(timings):.2f} с, всего {sum(timings):.2f} с на {len(timings)} запросов')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Время до первой клавиатуры с результатами поиска')
+    parser.add_argument('queries', nargs='*')
+    parser.add_argument('--db', default=DATABASE_FILE, help='база, из которой берутся запросы')
+    parser.add_argument('--fake', action='store_true', help='поддельный YouTube из bench_bot.py')
+    parser.add_argument('--search-ms', type=int, default=300, help='задержка страницы поиска с --fake')
+    parser.add_argument('--probe-ms', type=int, default=200,
+                        help='задержка разбора одного видео с --fake (старый поиск разбирает каждое)')
+    args = parser.parse_args()
+    queries = args.queries or history_queries(args.db)
+    if not queries:
+        sys.exit('Нет запросов: передайте их аргументами или заполните search_history')
+
+    workdir = None
+    if not os.environ.get('REFINDER_SETTINGS'):
+        workdir = tempfile.mkdtemp(prefix='refinder-search-')
+        settings = types.ModuleType('bench_search_settings')
+        settings.DATABASE_FILE = os.path.join(workdir, 'telemusic.db')
+        settings.CACHE_DB_FILE = os.path.join(workdir, 'telegram_bot_cache.db')
+        settings.CACHE_JSON_FILE = os.path.join(workdir, 'telegram_bot_cache.json')
+        settings.LOG_LEVEL = 'WARNING'
+        if args.fake:
+            from bench_bot import FakeYoutubeDL
+            FakeYoutubeDL.search_latency = args.search_ms / 1000
+            FakeYoutubeDL.probe_latency = args.probe_ms / 1000
+            settings.YDL_FACTORY = FakeYoutubeDL
+        sys.modules[settings.__name__] = settings
+        os.environ['REFINDER_SETTINGS'] = settings.__name__
+    import refinderbot
+
+    refinderbot.init_storage()
+    report('старый поиск', measure(refinderbot, queries, legacy_keyboard))
+    report('без кэша', measure(refinderbot, queries))
+    report('из кэша', measure(refinderbot, queries))
+    if workdir:
+        shutil.rmtree(workdir, ignore_errors=True)
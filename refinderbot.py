@@ -5,202 +5,911 @@ import re
 import logging
 import json
 import sqlite3
-from datetime import datetime
 import time
+import threading
+import importlib
+import secrets
+import atexit
+import signal
+import sys
+import fcntl
+import multiprocessing
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import queue
+import bisect
+import difflib
+import zlib
+import subprocess
+from collections import Counter, OrderedDict, deque, namedtuple
+from concurrent.futures import Future, ProcessPoolExecutor
 from telebot import types
 
 
 ####НАСТРОЙКИ БОТА
 ADMIN_USER_ID = '123456789'  #ID администратора для рассылки сообщений
 DATABASE_FILE = 'telemusic.db'  #путь к файлу базы данных
-CACHE_DB_FILE = 'telegram_bot_cache.json'  #путь к файлу кэша
+CACHE_DB_FILE = 'telegram_bot_cache.db'  #путь к файлу кэша (SQLite)
+CACHE_JSON_FILE = 'telegram_bot_cache.json'  #старый JSON-кэш, при наличии переносится в CACHE_DB_FILE при старте
 DOWNLOAD_DIR = "/path/to/dir/"  #папка для загруженных файлов
 CACHE_LIFETIME = 60*60*24*30*6  #время жизни кэша результатов поиска (в секундах, здесь 6 месяцев)
+CACHE_MAX_ENTRIES = 10000  #максимальное количество запросов в кэше поиска, давно не использованные вытесняются
+CACHE_CLEANUP_INTERVAL = 60*60  #как часто фоновый поток чистит кэш (в секундах)
+SESSION_TTL = 60*60*24*7  #сколько работают кнопки под результатами поиска (в секундах, здесь неделя)
+SESSION_MAX = 10000  #максимальное количество сессий поиска в памяти, остальные подгружаются из базы
+SEARCH_FUZZY_THRESHOLD = 1  #запрос из кэша с опечаткой: те же слова, отличающиеся написанием не меньше чем на эту долю (difflib), 1 - только точные совпадения
 FILE_ROTATE = 50  #максимальное количество хранимых аудиофайлов
+FILE_ROTATE_BYTES = 500*1024*1024  #максимальный суммарный размер хранимых аудиофайлов в байтах
 MAX_LONG = 720  #максимальная длительность загрузки музыки в секундах (12 минут)(при прямой ссылке)
 RESULTS_PAGES = 5  #количество результатов, отображаемых на странице.
 MAX_TITLE_LENGTH = 40  #максимально допустимая длина заголовка перед усечением или сжатием
 DROP_VOWELS = 50  #процент гласных, которые нужно сжать в заголовке.
 MAX_RESULTS = 15  #количество возвращаемых результатов поиска («ytsearch10» возвращает первые 10)..
 MAX_DURATION = 900  #максимальная продолжительность видео в секундах (15 минут)(при поиске)
+DOWNLOAD_WORKERS = 3  #сколько треков одновременно скачивается с YouTube (процессы, сеть), на все процессы бота, включая webhook
+CONVERT_WORKERS = 2  #сколько конвертаций ffmpeg идет одновременно (CPU), тоже на все процессы бота
+SEARCH_EXTRACTORS = 4  #сколько поисков на YouTube может идти одновременно (у каждого свой экземпляр YoutubeDL)
+JOB_QUEUE_SIZE = 100  #максимальное количество задач загрузки в очереди
+VIDEO_LOCKS = 256  #сколько файлов блокировок загрузки в DOWNLOAD_DIR/.locks, видео распределяются по ним по хэшу ID
+USER_JOBS_MAX = 5  #сколько задач загрузки одного пользователя может ждать в очереди
+USER_RATE_LIMITS = {'search': (6, 3), 'download': (10, 5)}  #на пользователя: (сколько в минуту, сколько можно подряд), администратора не касается
+USER_BUCKETS_MAX = 10000  #сколько лимитов пользователей держать в памяти, у давно не писавших лимит начинается заново
+AUDIO_PASSTHROUGH = True  #m4a (AAC) с YouTube отдавать без перекодирования, в mp3 перекодировать только остальное
+AUDIO_EXTENSIONS = ('mp3', 'm4a')  #форматы файлов в хранилище
+AUDIO_TIERS = {'high': 256, 'medium': 192, 'low': 128}  #качество mp3 при перекодировании (kbps), от лучшего к худшему
+AUDIO_TIER_DURATIONS = [(6*60, 'high'), (12*60, 'medium')]  #треки до 6 минут - high, до 12 - medium, длиннее - low
+AUDIO_HIGH_LOAD = 20  #если в очереди загрузок столько задач, качество снижается на ступень
+PREFETCH_TOP_K = 0  #сколько первых результатов нового поиска скачивать заранее, пока пользователь выбирает, 0 - выключено
+PREFETCH_WORKERS = 1  #потоков заранее скачивания, работают только когда очередь загрузок пуста
+PREFETCH_MAX_LOAD = 2.0  #не скачивать заранее, если средняя загрузка CPU за минуту (loadavg) выше
+PREFETCH_MAX_BYTES = 100*1024*1024  #сколько места могут занимать скачанные заранее и еще никем не выбранные треки
+PREFETCH_PER_MINUTE = 10  #не больше стольких треков в минуту скачивается заранее (трафик)
+PREFETCH_MAX_AGE = 5*60  #через сколько секунд после поиска без нажатий заранее скачивание отменяется
+DB_FLUSH_INTERVAL = 2  #как часто история пишется в базу (в секундах)
+DB_FLUSH_BATCH = 200  #писать сразу, если в очереди набралось столько записей
+BROADCAST_SENDERS = 4  #сколько потоков одновременно отправляют рассылку
+BROADCAST_RATE = 25  #сообщений рассылки в секунду на всех (лимит Telegram - около 30)
+BROADCAST_MAX_ATTEMPTS = 5  #сколько раз пробовать отправить сообщение рассылки одному пользователю
+BOT_MODE = 'polling'  #'polling' - один процесс опрашивает Telegram, 'webhook' - HTTP-сервер и WEBHOOK_WORKERS процессов
+WEBHOOK_URL = 'https://example.com/refinder'  #внешний адрес для Telegram (HTTPS обычно дает обратный прокси)
+WEBHOOK_HOST = '127.0.0.1'  #где слушает HTTP-сервер для webhook
+WEBHOOK_PORT = 8080
+WEBHOOK_SECRET = 'change-me'  #секрет, который Telegram передает в заголовке X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_WORKERS = 4  #процессов-обработчиков, сообщения одного чата всегда идут в один процесс по порядку
+BOT_API_URL = None  #адрес Bot API сервера, например локального для тестов 'http://127.0.0.1:8081', None - api.telegram.org
+STATS_PORT = None  #порт HTTP с метриками для Prometheus (/metrics), в режиме webhook у процесса-обработчика N - STATS_PORT + N, None - выключено
+PROFILER_INTERVAL = 0.01  #как часто профилировщик (/profile) снимает стеки потоков (в секундах)
+LOG_LEVEL = 'INFO'  #'DEBUG' - подробно, включая запросы к Telegram, под нагрузкой слишком много
+BOT_TOKEN = 'KEY'  #токен Telegram бота
+FFMPEG = 'ffmpeg'  #путь к ffmpeg
+YDL_FACTORY = yt_dlp.YoutubeDL  #класс загрузчика, bench_bot.py подставляет заглушку без сети
 
-bot = telebot.TeleBot('KEY')# Токен Telegram бота
-logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=logging.DEBUG)
-requests = {}
-cached_search_results = {}
-downloaded_files_cache = {}
+#настройки можно переопределить, не меняя этот файл: REFINDER_SETTINGS - имя модуля, из него берутся имена ЗАГЛАВНЫМИ
+if os.environ.get('REFINDER_SETTINGS'):
+    settings = importlib.import_module(os.environ['REFINDER_SETTINGS'])
+    globals().update({name: value for name, value in vars(settings).items() if name.isupper()})
+
+bot = None  #создается в create_bot() при запуске, а не при импорте
+logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=LOG_LEVEL)
+
+
+##МЕТРИКИ
+#время этапов - гистограммы с постоянными корзинами (как в Prometheus), плюс счетчики событий
+STATS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)  #верхние границы корзин (секунды)
+stage_stats = {}  #этап -> корзины, сумма, количество, ошибки
+event_counts = {}  #событие -> сколько раз
+stats_lock = threading.Lock()
+
+def observe(stage, seconds, error=False):
+    with stats_lock:
+        stats = stage_stats.get(stage)
+        if stats is None:
+            stats = stage_stats[stage] = {'buckets': [0] * (len(STATS_BUCKETS) + 1), 'sum': 0.0, 'count': 0, 'errors': 0}
+        stats['buckets'][bisect.bisect_left(STATS_BUCKETS, seconds)] += 1
+        stats['sum'] += seconds
+        stats['count'] += 1
+        if error:
+            stats['errors'] += 1
+
+#и with timed('этап'), и декоратор @timed('этап'); исключение считается ошибкой этапа
+@contextmanager
+def timed(stage):
+    started = time.monotonic()
+    error = True
+    try:
+        yield
+        error = False
+    finally:
+        observe(stage, time.monotonic() - started, error)
+
+def count_event(name, amount=1):
+    with stats_lock:
+        event_counts[name] = event_counts.get(name, 0) + amount
+
+#квантиль по гистограмме: верхняя граница корзины, в которую он попал
+def stage_quantile(stats, q):
+    seen = 0
+    for bound, count in zip(STATS_BUCKETS + (float('inf'),), stats['buckets']):
+        seen += count
+        if seen >= q * stats['count']:
+            return bound
+    return float('inf')
 
 
 ##БД
-# Подключаемся к базе данных 
-conn = sqlite3.connect(DATABASE_FILE)
-cursor = conn.cursor()
-# Создаем таблицу пользователей
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS users (
-    id INTEGER PRIMARY KEY,
-    username TEXT NOT NULL,
-    status TEXT DEFAULT NULL
-)
-''')
-
-# Создаем таблицу истории запросов
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS search_history (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user_id INTEGER NOT NULL,
-    username TEXT NOT NULL,
-    keywords TEXT NOT NULL,
-    last_call TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    UNIQUE(user_id, keywords),
-    FOREIGN KEY(user_id) REFERENCES users(id)
-)
-''')
-
-# Создаем таблицу истории загрузок
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS download_history (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user_id INTEGER NOT NULL,
-    username TEXT NOT NULL,
-    video_url TEXT NOT NULL,
-    filename TEXT NOT NULL,
-    UNIQUE(user_id, video_url),
-    FOREIGN KEY(user_id) REFERENCES users(id)
-)
-''')
-
-conn.commit()  # Сохраняем изменения
-conn.close()   # Закрываем соединение с базой данных
+#таблицы истории, создаются при запуске (init_storage)
+def init_db():
+    # Подключаемся к базе данных 
+    conn = sqlite3.connect(DATABASE_FILE)
+    cursor = conn.cursor()
+    # Создаем таблицу пользователей
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY,
+        username TEXT NOT NULL,
+        status TEXT DEFAULT NULL
+    )
+    ''')
+
+    # Создаем таблицу истории запросов
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS search_history (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        username TEXT NOT NULL,
+        keywords TEXT NOT NULL,
+        last_call TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE(user_id, keywords),
+        FOREIGN KEY(user_id) REFERENCES users(id)
+    )
+    ''')
+
+    # Создаем таблицу истории загрузок
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS download_history (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        username TEXT NOT NULL,
+        video_url TEXT NOT NULL,
+        filename TEXT NOT NULL,
+        UNIQUE(user_id, video_url),
+        FOREIGN KEY(user_id) REFERENCES users(id)
+    )
+    ''')
+
+    # Создаем таблицу замеров обработки аудио: сравнение времени CPU и размера файла по качеству
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS transcode_log (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        video_id TEXT NOT NULL,
+        tier TEXT NOT NULL,
+        mode TEXT NOT NULL,
+        source_bytes INTEGER NOT NULL,
+        output_bytes INTEGER NOT NULL,
+        seconds REAL NOT NULL,
+        cpu_seconds REAL NOT NULL,
+        created TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
+
+    # Создаем таблицы рассылок: получатель отмечается после отправки, чтобы после перезапуска продолжить
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS broadcasts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        text TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'running',
+        created TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        finished TIMESTAMP DEFAULT NULL
+    )
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS broadcast_recipients (
+        broadcast_id INTEGER NOT NULL,
+        chat_id INTEGER NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        error TEXT DEFAULT NULL,
+        PRIMARY KEY(broadcast_id, chat_id),
+        FOREIGN KEY(broadcast_id) REFERENCES broadcasts(id)
+    )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_broadcast_recipients_status ON broadcast_recipients(broadcast_id, status)')
+
+    # Номер выбранного результата в поиске и был ли трек скачан заранее - чтобы подобрать PREFETCH_TOP_K по реальным нажатиям
+    download_columns = [column[1] for column in cursor.execute('PRAGMA table_info(download_history)')]
+    if 'result_index' not in download_columns:
+        cursor.execute('ALTER TABLE download_history ADD COLUMN result_index INTEGER DEFAULT NULL')
+    if 'prefetched' not in download_columns:
+        cursor.execute('ALTER TABLE download_history ADD COLUMN prefetched INTEGER DEFAULT NULL')
+
+    conn.commit()  # Сохраняем изменения
+    conn.close()   # Закрываем соединение с базой данных
+
+# Одно соединение на все время работы процесса, открывается в start_db_writer
+db_conn = None
+db_lock = threading.Lock()
+db_writes = queue.Queue()  #(SQL, параметры) ожидающие записи
+seen_users = set()  #пользователи, уже записанные в этом запуске
+pending_users = {}  #ID -> (имя, статус) новых пользователей, еще не записанных в базу
+pending_users_lock = threading.Lock()
 
 
+#соединение для чтения, в режиме WAL не ждет писателя
 def db_connect():
     return sqlite3.connect(DATABASE_FILE) 
     
 #добавляем пользователя в базу данных
 def db_add_user(user_id, username, status=None):
-    conn = sqlite3.connect(DATABASE_FILE)
-    cursor = conn.cursor()
-    cursor.execute('INSERT OR IGNORE INTO users (id, username, status) VALUES (?, ?, ?)', (user_id, username, status))
-    conn.commit()
-    conn.close()
+    if user_id in seen_users:  # Повторный пользователь - в базу не пишем
+        return
+    seen_users.add(user_id)
+    with pending_users_lock:
+        pending_users[user_id] = (username, status)
+    db_writes.put((None, None))  # Запись в очереди - только сигнал, пользователей пишет db_write_users
+
+#новые пользователи отдельно от остальной истории: рассылке нужны только они (вызывать под db_lock)
+def db_write_users(cursor):
+    with pending_users_lock:
+        users = [(user_id, username, status) for user_id, (username, status) in pending_users.items()]
+        pending_users.clear()
+    cursor.executemany('INSERT OR IGNORE INTO users (id, username, status) VALUES (?, ?, ?)', users)
     
 #добавляем запись в историю поиска
 def db_add_search(user_id, username, keywords):
-    conn = sqlite3.connect(DATABASE_FILE)
-    cursor = conn.cursor()
-    cursor.execute('''
+    db_writes.put(('''
     INSERT INTO search_history (user_id, username, keywords, last_call)
-    VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+    VALUES (?, ?, ?, ?)
     ON CONFLICT(user_id, keywords) DO UPDATE SET last_call = excluded.last_call
-    ''', (user_id, username, keywords))
-    conn.commit()
-    conn.close()
+    ''', (user_id, username, keywords, time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime()))))  # Время запроса, а не записи
     
 #добавляем запись в историю загрузок
-def db_add_download(user_id, username, video_url, filename):
-    conn = sqlite3.connect(DATABASE_FILE)
+def db_add_download(user_id, username, video_url, filename, result_index=None, prefetched=None):
+    db_writes.put(('''
+    INSERT INTO download_history (user_id, username, video_url, filename, result_index, prefetched)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT(user_id, video_url) DO UPDATE SET
+        filename = excluded.filename, result_index = excluded.result_index, prefetched = excluded.prefetched
+    ''', (user_id, username, video_url, filename, result_index, prefetched)))
+
+#пачка записей - одна транзакция, ошибка в одной записи не теряет остальные
+@timed('db_write')
+def db_write_batch(batch):
+    with db_lock:
+        cursor = db_conn.cursor()
+        for sql, params in batch:
+            try:
+                if sql is None:
+                    db_write_users(cursor)
+                else:
+                    cursor.execute(sql, params)
+            except sqlite3.Error as e:
+                logging.error(f'Не удалось записать в базу {params}: {e}')
+        db_conn.commit()
+
+#сбрасываем очередь, когда набралось DB_FLUSH_BATCH записей или прошло DB_FLUSH_INTERVAL секунд
+#(история - db_writes, и так же отложенные обновления кэша - cache_writes)
+def db_writer(writes=db_writes, write_batch=db_write_batch):
+    while True:
+        batch = [writes.get()]
+        deadline = time.monotonic() + DB_FLUSH_INTERVAL
+        while len(batch) < DB_FLUSH_BATCH:
+            try:
+                batch.append(writes.get(timeout=max(0, deadline - time.monotonic())))
+            except queue.Empty:
+                break
+        try:
+            write_batch(batch)
+        except sqlite3.Error as e:
+            logging.error(f'Ошибка записи в базу: {e}')
+        finally:
+            for _ in batch:
+                writes.task_done()
+
+def drain_writes(writes):
+    batch = []
+    while True:
+        try:
+            batch.append(writes.get_nowait())
+        except queue.Empty:
+            return batch
+
+#при завершении дописываем все, что осталось в очереди
+def db_flush():
+    batch = drain_writes(db_writes)
+    if db_conn is None:  # Процесс, который не пишет историю (прием webhook)
+        return
+    if batch:
+        db_write_batch(batch)
+        for _ in batch:
+            db_writes.task_done()
+    db_writes.join()  # Дожидаемся пачки, которую сейчас пишет db_writer
+
+#пишет в соединение только фоновый поток db_writer (и db_flush при завершении)
+def start_db_writer():
+    global db_conn
+    db_conn = sqlite3.connect(DATABASE_FILE, check_same_thread=False, timeout=30)
+    db_conn.execute('PRAGMA journal_mode=WAL')  # Чтение (рассылка) не мешает записи
+    db_conn.execute('PRAGMA synchronous=NORMAL')  # В режиме WAL fsync только при чекпойнте
+    threading.Thread(target=db_writer, daemon=True).start()
+    threading.Thread(target=db_writer, args=(cache_writes, cache_write_batch), daemon=True).start()
+
+atexit.register(db_flush)
+
+
+##КЕШ ПОИСКА
+#кэш хранится в SQLite: у каждого потока одно соединение на все время работы,
+#записи - через "with cache_connect() as conn:" (коммит, при ошибке откат)
+cache_local = threading.local()
+cache_writes = queue.Queue()  #(SQL, параметры) отложенных обновлений кэша: время последнего обращения
+
+def cache_connect():
+    conn = getattr(cache_local, 'conn', None)
+    if conn is None or cache_local.pid != os.getpid():  # Соединение родителя после fork не используем
+        conn = sqlite3.connect(CACHE_DB_FILE, timeout=30)
+        conn.execute('PRAGMA synchronous=NORMAL')  # В режиме WAL fsync только при чекпойнте
+        cache_local.conn, cache_local.pid = conn, os.getpid()
+    return conn
+
+#время обращения нужно только для вытеснения, его можно записать позже одной транзакцией с остальными
+def cache_touch(sql, params):
+    cache_writes.put((sql, params))
+
+@timed('cache_write')
+def cache_write_batch(batch):
+    with cache_connect() as conn:
+        cursor = conn.cursor()
+        for sql, params in batch:
+            try:
+                cursor.execute(sql, params)
+            except sqlite3.Error as e:
+                logging.error(f'Не удалось записать в кэш {params}: {e}')
+
+def cache_flush():
+    batch = drain_writes(cache_writes)
+    if batch:
+        cache_write_batch(batch)
+        for _ in batch:
+            cache_writes.task_done()
+    cache_writes.join()
+
+atexit.register(cache_flush)
+
+def init_cache():
+    conn = cache_connect()
     cursor = conn.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')  # Читатели не блокируют писателя
     cursor.execute('''
-    INSERT INTO download_history (user_id, username, video_url, filename)
-    VALUES (?, ?, ?, ?)
-    ON CONFLICT(user_id, video_url) DO UPDATE SET filename = excluded.filename
-    ''', (user_id, username, video_url, filename))
+    CREATE TABLE IF NOT EXISTS search_cache (
+        keywords TEXT PRIMARY KEY,
+        results TEXT NOT NULL,
+        timestamp REAL NOT NULL,
+        last_access REAL NOT NULL
+    )
+    ''')
+    # Сколько позиций выдачи уже просмотрено, чтобы догружать следующие страницы
+    if 'fetched' not in [column[1] for column in cursor.execute('PRAGMA table_info(search_cache)')]:
+        cursor.execute('ALTER TABLE search_cache ADD COLUMN fetched INTEGER')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_search_cache_timestamp ON search_cache(timestamp)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_search_cache_last_access ON search_cache(last_access)')
+    # Индекс слов нормализованных запросов для нечеткого поиска по кэшу
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS search_tokens (
+        token TEXT NOT NULL,
+        keywords TEXT NOT NULL,
+        PRIMARY KEY(token, keywords)
+    )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_search_tokens_keywords ON search_tokens(keywords)')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS file_cache (
+        url TEXT PRIMARY KEY,
+        file_path TEXT NOT NULL,
+        download_url TEXT
+    )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_file_cache_file_path ON file_cache(file_path)')
+    # Индекс хранилища аудио, общий для всех процессов
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS audio_files (
+        video_id TEXT PRIMARY KEY,
+        ext TEXT NOT NULL DEFAULT 'mp3',
+        size INTEGER NOT NULL,
+        last_used REAL NOT NULL
+    )
+    ''')
+    if 'ext' not in [column[1] for column in cursor.execute('PRAGMA table_info(audio_files)')]:
+        cursor.execute("ALTER TABLE audio_files ADD COLUMN ext TEXT NOT NULL DEFAULT 'mp3'")
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_audio_files_last_used ON audio_files(last_used)')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS sessions (
+        search_id TEXT PRIMARY KEY,
+        chat_id INTEGER NOT NULL,
+        keywords TEXT NOT NULL,
+        tracks TEXT NOT NULL,
+        fetched INTEGER NOT NULL,
+        last_access REAL NOT NULL
+    )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_sessions_last_access ON sessions(last_access)')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS video_meta (
+        video_id TEXT PRIMARY KEY,
+        title TEXT NOT NULL,
+        duration INTEGER,
+        formats TEXT NOT NULL,
+        timestamp REAL NOT NULL
+    )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_video_meta_timestamp ON video_meta(timestamp)')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS file_ids (
+        video_id TEXT PRIMARY KEY,
+        file_id TEXT NOT NULL
+    )
+    ''')
+    # Старые записи файлов были по полной ссылке, переводим их на ID видео
+    cursor.execute("SELECT url FROM file_cache WHERE url LIKE '%/%'")
+    for (url,) in cursor.fetchall():
+        cursor.execute('UPDATE OR IGNORE file_cache SET url = ? WHERE url = ?', (get_video_id(url) or url, url))
+    index_search_keys(cursor)
     conn.commit()
-    conn.close()
 
-#объявления, chat_id из базы данных
-def load_chat_ids():
-    conn = sqlite3.connect(DATABASE_FILE)
-    cursor = conn.cursor()
-    cursor.execute('SELECT id FROM users')
-    chat_ids = [row[0] for row in cursor.fetchall()]
-    conn.close()
-    return chat_ids
+#записи поиска до нормализации запросов (и из JSON-кэша) переводим на ключ normalize_query и индексируем слова
+def index_search_keys(cursor):
+    for (keywords,) in cursor.execute('SELECT keywords FROM search_cache').fetchall():
+        key = normalize_query(keywords)
+        if key != keywords:
+            cursor.execute('UPDATE OR IGNORE search_cache SET keywords = ? WHERE keywords = ?', (key, keywords))
+            cursor.execute('DELETE FROM search_cache WHERE keywords = ?', (keywords,))  # Ключ уже был - оставляем его
+    cursor.execute('SELECT keywords FROM search_cache WHERE keywords NOT IN (SELECT keywords FROM search_tokens)')
+    cursor.executemany('INSERT OR IGNORE INTO search_tokens (token, keywords) VALUES (?, ?)',
+                       [(token, key) for (key,) in cursor.fetchall() for token in key.split()])
 
-
-##КЕШ ПОИСКА
-#для подгрузки найденого
-def load_cache():
+#разовый перенос старого JSON-кэша в SQLite
+def import_json_cache(json_file=CACHE_JSON_FILE):
     try:
-        with open(CACHE_DB_FILE, 'r') as f:
+        with open(json_file, 'r') as f:
             data = json.load(f)
-            cached_search_results.update(data.get('search_results', {}))
-            downloaded_files_cache.update(data.get('files', {}))
     except FileNotFoundError:
-        logging.info(f"Файл кэша {CACHE_DB_FILE} отсутствует и будет создан новый.")
+        return
     except json.JSONDecodeError as e:
         logging.error(f"Ошибка декодирования JSON из файла кэша: {e}")
+        return
+    conn = cache_connect()
+    cursor = conn.cursor()
+    cursor.executemany(
+        'INSERT OR IGNORE INTO search_cache (keywords, results, timestamp, last_access) VALUES (?, ?, ?, ?)',
+        [(normalize_query(keywords), json.dumps(cached['results']), cached['timestamp'], cached['timestamp'])
+         for keywords, cached in data.get('search_results', {}).items()])
+    index_search_keys(cursor)
+    cursor.executemany(
+        'INSERT OR IGNORE INTO file_cache (url, file_path, download_url) VALUES (?, ?, ?)',
+        [(url, cached['file_path'], cached.get('download_url', url))
+         for url, cached in data.get('files', {}).items()])
+    cursor.executemany(
+        'INSERT OR IGNORE INTO file_ids (video_id, file_id) VALUES (?, ?)',
+        list(data.get('file_ids', {}).items()))
+    conn.commit()
+    os.rename(json_file, json_file + '.imported')  # Чтобы не импортировать повторно
+    logging.info(f'Кэш из {json_file} перенесен в {CACHE_DB_FILE}')
 
-def save_cache():
-    with open(CACHE_DB_FILE, 'w') as f:
-        files_data = {url: {'file_path': data['file_path']} for url, data in downloaded_files_cache.items()}
-        
-        json.dump({
-            'search_results': cached_search_results,
-            'files': files_data
-        }, f, indent=4)
-# Загрузка кэша при старте бота
-load_cache()
-
-# Получаем результаты из кэша, если они не устарели
+#удаляем устаревшие записи (TTL) и самые давно использованные сверх лимита (LRU)
+def cleanup_cache(max_entries=CACHE_MAX_ENTRIES):
+    with cache_connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute('DELETE FROM search_cache WHERE timestamp <= ?', (time.time() - CACHE_LIFETIME,))
+        expired = cursor.rowcount
+        cursor.execute('DELETE FROM video_meta WHERE timestamp <= ?', (time.time() - CACHE_LIFETIME,))
+        cursor.execute('DELETE FROM sessions WHERE last_access <= ?', (time.time() - SESSION_TTL,))
+        cursor.execute('''
+        DELETE FROM search_cache WHERE keywords IN (
+            SELECT keywords FROM search_cache ORDER BY last_access DESC LIMIT -1 OFFSET ?
+        )
+        ''', (max_entries,))
+        evicted = cursor.rowcount
+        if expired or evicted:
+            cursor.execute('DELETE FROM search_tokens WHERE keywords NOT IN (SELECT keywords FROM search_cache)')
+    if expired or evicted:
+        logging.info(f'Очистка кэша: устарело {expired}, вытеснено {evicted}')
+
+def cache_cleanup_loop():
+    while True:
+        try:
+            cleanup_cache()
+        except sqlite3.Error as e:
+            logging.error(f'Ошибка очистки кэша: {e}')
+        time.sleep(CACHE_CLEANUP_INTERVAL)
+
+def start_cache_cleanup():
+    threading.Thread(target=cache_cleanup_loop, daemon=True).start()
+
+#базы готовятся при запуске, а не при импорте: так модуль можно импортировать для замеров (bench_bot.py)
+def init_storage():
+    init_db()
+    init_cache()
+    import_json_cache()
+
+#попадания в кэш поиска с момента запуска - события search_cache_exact, search_cache_fuzzy, search_cache_miss
+def search_cache_stats():
+    with stats_lock:
+        return {hit: event_counts.get(f'search_cache_{hit}', 0) for hit in ('exact', 'fuzzy', 'miss')}
+
+def search_cache_hit_rate():
+    stats = search_cache_stats()
+    total = sum(stats.values())
+    return (stats['exact'] + stats['fuzzy']) / total if total else 0.0
+
+#закэшированные запросы, отличающиеся только написанием слов, от самого похожего, [] - если таких нет
+def find_similar_queries(cursor, key, threshold=SEARCH_FUZZY_THRESHOLD):
+    tokens = set(key.split())
+    if not tokens or threshold >= 1:
+        return []
+    cursor.execute(f'''
+    SELECT DISTINCT keywords FROM search_tokens WHERE token IN ({','.join('?' * len(tokens))})
+    ''', sorted(tokens))
+    scored = []
+    for (candidate,) in cursor.fetchall():
+        candidate_tokens = set(candidate.split())
+        # Лишнее или недостающее слово (live, remix, cover) - уже другой запрос
+        if candidate == key or len(candidate_tokens) != len(tokens):
+            continue
+        score = spelling_score(tokens - candidate_tokens, candidate_tokens - tokens)
+        if score >= threshold:
+            scored.append((score, candidate))
+    return [candidate for _, candidate in sorted(scored, reverse=True)]
+
+#насколько отличающиеся слова похожи друг на друга по написанию: худшая из пар
+def spelling_score(missing, extra):
+    extra = list(extra)
+    worst = 1
+    for word in missing:
+        ratio, match = max((difflib.SequenceMatcher(None, word, other).ratio(), other) for other in extra)
+        extra.remove(match)
+        worst = min(worst, ratio)
+    return worst
+
+# Получаем результаты из кэша, если они не устарели: (результаты, сколько позиций выдачи уже просмотрено)
+@timed('cache_lookup')
 def get_cached_search_results(keywords):
     cur_time = time.time()
-    cached = cached_search_results.get(keywords, None)
-    if cached and cur_time - cached['timestamp'] < CACHE_LIFETIME:  # Проверяем возраст кэша
-        return cached['results']
-    else:
-        return None
+    key = normalize_query(keywords)
+    conn = cache_connect()
+    cursor = conn.cursor()
+    cursor.execute('SELECT results, fetched FROM search_cache WHERE keywords = ? AND timestamp > ?',
+                   (key, cur_time - CACHE_LIFETIME))  # Проверяем возраст кэша
+    row = cursor.fetchone()
+    hit = 'exact' if row else 'miss'
+    if not row:
+        for similar in find_similar_queries(cursor, key):  # Лучший мог устареть - тогда следующий
+            cursor.execute('SELECT results, fetched FROM search_cache WHERE keywords = ? AND timestamp > ?',
+                           (similar, cur_time - CACHE_LIFETIME))
+            row = cursor.fetchone()
+            if row:
+                hit, key = 'fuzzy', similar
+                logging.info(f'Запрос "{keywords}" отдан из кэша по похожему "{similar}"')
+                break
+    count_event(f'search_cache_{hit}')
+    if row:
+        cache_touch('UPDATE search_cache SET last_access = MAX(last_access, ?) WHERE keywords = ?', (cur_time, key))
+        return json.loads(row[0]), MAX_RESULTS if row[1] is None else row[1]  # Старые записи искались целиком
+    return None
         
 # Сохраняем результаты и временную метку в кэш
-def cache_search_results(keywords, results):
-    cached_search_results[keywords] = {
-        'timestamp': time.time(),
-        'results': results
-    }
-    save_cache()  # Сохраняем кэш при каждом его обновлении
+def cache_search_results(keywords, results, fetched=MAX_RESULTS):
+    cur_time = time.time()
+    key = normalize_query(keywords)
+    with cache_connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+        INSERT INTO search_cache (keywords, results, fetched, timestamp, last_access) VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(keywords) DO UPDATE SET results = excluded.results, fetched = excluded.fetched,
+            timestamp = excluded.timestamp, last_access = excluded.last_access
+        ''', (key, json.dumps(results), fetched, cur_time, cur_time))
+        cursor.executemany('INSERT OR IGNORE INTO search_tokens (token, keywords) VALUES (?, ?)',
+                           [(token, key) for token in key.split()])
     
+#файлы в кэше хранятся по ID видео, а не по строке ссылки
 def get_cached_file_path(url):
-    cached = downloaded_files_cache.get(url, None)
-    if cached:
-        return cached['file_path'], url
+    conn = cache_connect()
+    cursor = conn.cursor()
+    cursor.execute('SELECT file_path, download_url FROM file_cache WHERE url = ?', (get_video_id(url) or url,))
+    row = cursor.fetchone()
+    if row:
+        return row[0], row[1] or url
     return None, url
     
 # Сохраняем путь к файлу и URL в кэш
 def cache_file_path(url, file_path, download_url):
-    downloaded_files_cache[url] = {
-        'file_path': file_path,
-        'download_url': download_url
-    }
-    save_cache()  # Сохраняем кэш при каждом его обновлении
+    with cache_connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+        INSERT INTO file_cache (url, file_path, download_url) VALUES (?, ?, ?)
+        ON CONFLICT(url) DO UPDATE SET file_path = excluded.file_path, download_url = excluded.download_url
+        ''', (get_video_id(url) or url, file_path, download_url))
+
+#метаданные видео (название, длительность, аудиоформаты) по ID
+def get_cached_video_meta(video_id):
+    conn = cache_connect()
+    cursor = conn.cursor()
+    cursor.execute('SELECT title, duration, formats FROM video_meta WHERE video_id = ? AND timestamp > ?',
+                   (video_id, time.time() - CACHE_LIFETIME))
+    row = cursor.fetchone()
+    if row:
+        return {'id': video_id, 'title': row[0], 'duration': row[1], 'formats': json.loads(row[2])}
+    return None
+
+def cache_video_meta(meta):
+    with cache_connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute('INSERT OR REPLACE INTO video_meta (video_id, title, duration, formats, timestamp) VALUES (?, ?, ?, ?, ?)',
+                       (meta['id'], meta['title'], meta['duration'], json.dumps(meta['formats']), time.time()))
+
+#файл удален из хранилища - все записи кэша, указывающие на него, больше не действительны
+def drop_cached_file_path(file_path):
+    with cache_connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute('DELETE FROM file_cache WHERE file_path = ?', (file_path,))
+
+#file_id, который Telegram вернул после первой загрузки трека
+def get_cached_file_id(url):
+    video_id = get_video_id(url)
+    if not video_id:
+        return None
+    conn = cache_connect()
+    cursor = conn.cursor()
+    cursor.execute('SELECT file_id FROM file_ids WHERE video_id = ?', (video_id,))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+def cache_file_id(url, file_id):
+    video_id = get_video_id(url)
+    if not video_id:
+        return
+    with cache_connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute('INSERT OR REPLACE INTO file_ids (video_id, file_id) VALUES (?, ?)', (video_id, file_id))
+
+def drop_cached_file_id(url):
+    video_id = get_video_id(url)
+    with cache_connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute('DELETE FROM file_ids WHERE video_id = ?', (video_id,))
     
     
+##СЕССИИ ПОИСКА
+#результаты каждого поиска живут под своим коротким ID, кнопки ссылаются на него, а не на чат
+Track = namedtuple('Track', 'video_id title duration')
+
+class SearchSession:
+    __slots__ = ('search_id', 'chat_id', 'keywords', 'tracks', 'fetched', 'last_access')
+
+    def __init__(self, search_id, chat_id, keywords, tracks, fetched, last_access):
+        self.search_id = search_id
+        self.chat_id = chat_id
+        self.keywords = keywords
+        self.tracks = tracks
+        self.fetched = fetched
+        self.last_access = last_access
+
+    def has_more(self):
+        return self.fetched < MAX_RESULTS
+
+    #результаты поиска (как в кэше) -> компактные записи
+    def set_results(self, results, fetched):
+        self.tracks = [Track(get_video_id(item['webpage_url']), item['title'], item['duration']) for item in results]
+        self.fetched = fetched
+
+    def results(self):
+        return [{'title': track.title, 'webpage_url': video_url(track.video_id), 'duration': track.duration}
+                for track in self.tracks]
+
+sessions = OrderedDict()  #ID поиска -> SearchSession, от давно использованных к недавним
+sessions_lock = threading.Lock()
+
+def new_session(chat_id, keywords, results, fetched):
+    session = SearchSession(secrets.token_hex(4), chat_id, keywords, [], 0, time.time())
+    session.set_results(results, fetched)
+    save_session(session)
+    remember_session(session)
+    return session
+
+def remember_session(session):
+    cur_time = time.time()
+    with sessions_lock:
+        sessions[session.search_id] = session
+        sessions.move_to_end(session.search_id)
+        # Сверх лимита и устаревшие уходят из памяти, в базе они остаются до истечения SESSION_TTL
+        while sessions and (len(sessions) > SESSION_MAX
+                            or next(iter(sessions.values())).last_access < cur_time - SESSION_TTL):
+            sessions.popitem(last=False)
+
+#сессия из памяти или из базы (после перезапуска), None - если устарела
+def get_session(search_id):
+    cur_time = time.time()
+    with sessions_lock:
+        session = sessions.get(search_id)
+    if session is None:
+        session = load_session(search_id)
+    if session is None or session.last_access < cur_time - SESSION_TTL:
+        return None
+    session.last_access = cur_time
+    remember_session(session)
+    touch_session(session)
+    return session
+
+#жива ли сессия, без продления: для фоновых задач, которые не должны держать поиск
+def session_alive(search_id, ttl=SESSION_TTL):
+    with sessions_lock:
+        session = sessions.get(search_id)
+    return session is not None and session.last_access >= time.time() - ttl
+
+def save_session(session):
+    with cache_connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+        INSERT OR REPLACE INTO sessions (search_id, chat_id, keywords, tracks, fetched, last_access)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ''', (session.search_id, session.chat_id, session.keywords,
+              json.dumps(session.tracks, ensure_ascii=False), session.fetched, session.last_access))
+
+def touch_session(session):
+    cache_touch('UPDATE sessions SET last_access = MAX(last_access, ?) WHERE search_id = ?',
+                (session.last_access, session.search_id))
+
+def load_session(search_id):
+    conn = cache_connect()
+    cursor = conn.cursor()
+    cursor.execute('SELECT chat_id, keywords, tracks, fetched, last_access FROM sessions WHERE search_id = ?',
+                   (search_id,))
+    row = cursor.fetchone()
+    if not row:
+        return None
+    tracks = [Track(*track) for track in json.loads(row[2])]
+    return SearchSession(search_id, row[0], row[1], tracks, row[3], row[4])
+
+
 ##ФАЙЛЫ
-#следим за скаченными файлами
-def rotate_files(directory, max_files=FILE_ROTATE):
-    files = [file for file in os.listdir(directory) if file.endswith('.mp3')]
-    while len(files) > max_files:
-        oldest_file = min(files, key=lambda x: os.path.getctime(os.path.join(directory, x)))
-        os.remove(os.path.join(directory, oldest_file))
-        files.remove(oldest_file)
-        logging.info(f'Удален старый файл: {oldest_file}')
-
-#сохраняем
-def safe_filename(filename):
-    safe_filename = re.sub(r'[\\/*?:"<>|]', "", filename)
-    safe_filename = re.sub(r'\s+', " ", safe_filename).strip()
-    return safe_filename
+#хранилище аудио: файлы называются по ID видео, индекс (размер и время использования) - в базе кэша,
+#поэтому он общий для всех процессов бота в режиме webhook
+def audio_path(video_id, ext='mp3'):
+    return os.path.join(DOWNLOAD_DIR, f'{video_id}.{ext}')
+
+#при старте сверяем индекс с папкой: новые файлы добавляем, пропавшие убираем
+def load_audio_store(directory=DOWNLOAD_DIR):
+    locks_dir = os.path.join(directory, '.locks')
+    os.makedirs(locks_dir, exist_ok=True)
+    lock_names = {f'{n}.lock' for n in range(VIDEO_LOCKS)}
+    lock_names |= {os.path.basename(path) for path in download_slots.paths + convert_slots.paths}
+    for entry in os.scandir(locks_dir):
+        if entry.name not in lock_names:  # Блокировки по одной на видео от прошлых версий
+            os.remove(entry.path)
+    files = {}
+    for entry in os.scandir(directory):
+        if not entry.is_file():
+            continue
+        video_id, _, ext = entry.name.rpartition('.')
+        if '.src.' in entry.name:  # Недокачанные исходники от прошлого запуска
+            os.remove(entry.path)
+        elif ext in AUDIO_EXTENSIONS:
+            files[video_id] = (ext, entry.stat())
+    conn = cache_connect()
+    cursor = conn.cursor()
+    cursor.executemany('INSERT OR IGNORE INTO audio_files (video_id, ext, size, last_used) VALUES (?, ?, ?, ?)',
+                       [(video_id, ext, stat.st_size, stat.st_mtime) for video_id, (ext, stat) in files.items()])
+    indexed = [row[0] for row in cursor.execute('SELECT video_id FROM audio_files')]
+    for video_id in indexed:
+        if video_id not in files:
+            cursor.execute('DELETE FROM audio_files WHERE video_id = ?', (video_id,))
+            cursor.execute('DELETE FROM file_cache WHERE url = ?', (video_id,))
+    count, total = cursor.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM audio_files').fetchone()
+    conn.commit()
+    rotate_files()
+    logging.info(f'Хранилище аудио: {count} файлов, {total} байт')
+
+def audio_store_add(video_id, ext='mp3'):
+    size = os.path.getsize(audio_path(video_id, ext))
+    with cache_connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute('INSERT OR REPLACE INTO audio_files (video_id, ext, size, last_used) VALUES (?, ?, ?, ?)',
+                       (video_id, ext, size, time.time()))
+    rotate_files(keep=video_id)
+
+#отмечаем использование файла, False - файла нет в хранилище
+def audio_store_touch(video_id):
+    with cache_connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute('UPDATE audio_files SET last_used = ? WHERE video_id = ?', (time.time(), video_id))
+        row = cursor.execute('SELECT ext FROM audio_files WHERE video_id = ?', (video_id,)).fetchone()
+    if not row:
+        return False
+    if not os.path.exists(audio_path(video_id, row[0])):
+        audio_store_remove(video_id)
+        return False
+    return True
+
+def audio_store_remove(video_id):
+    with cache_connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute('DELETE FROM audio_files WHERE video_id = ?', (video_id,))
+        cursor.execute('DELETE FROM file_cache WHERE url = ?', (video_id,))
+
+#следим за скаченными файлами: вытесняем давно не использованные сверх лимитов
+def rotate_files(max_files=FILE_ROTATE, max_bytes=FILE_ROTATE_BYTES, keep=None):
+    with cache_connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute('BEGIN IMMEDIATE')  # Вытесняет один процесс за раз
+        count, total = cursor.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM audio_files').fetchone()
+        removed = []
+        for video_id, ext, size in cursor.execute('SELECT video_id, ext, size FROM audio_files ORDER BY last_used').fetchall():
+            if count <= max_files and total <= max_bytes:
+                break
+            if video_id == keep:  # Только что скачанный файл не удаляем, даже если он один больше лимита
+                continue
+            # Запись кэша убираем в той же транзакции, чтобы никто не получил путь к удаляемому файлу
+            cursor.execute('DELETE FROM audio_files WHERE video_id = ?', (video_id,))
+            cursor.execute('DELETE FROM file_cache WHERE url = ?', (video_id,))
+            removed.append(audio_path(video_id, ext))
+            count -= 1
+            total -= size
+    for file_path in removed:
+        try:
+            os.remove(file_path)
+        except FileNotFoundError:
+            pass
+        logging.info(f'Удален старый файл: {file_path}')
+
+#одно видео качает только один процесс, остальные ждут и берут готовый файл из кэша
+#файлов блокировок постоянное число: редкие совпадения хэша только ставят разные видео в очередь друг за другом
+@contextmanager
+def video_file_lock(video_id):
+    lock_number = zlib.crc32(video_id.encode('utf-8')) % VIDEO_LOCKS
+    with open(os.path.join(DOWNLOAD_DIR, '.locks', f'{lock_number}.lock'), 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+#ограничение на все процессы бота сразу (в режиме webhook у каждого процесса свои потоки и пул загрузок):
+#value файлов блокировок в .locks, занятое место - взятая на файл flock, она снимается и при падении процесса
+class ProcessSlots:
+    def __init__(self, name, value):
+        self.paths = [os.path.join(DOWNLOAD_DIR, '.locks', f'{name}-{n}.lock') for n in range(value)]
+        self.held = threading.local()
+
+    def __enter__(self):
+        while True:
+            for path in self.paths:
+                lock_file = open(path, 'w')
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    lock_file.close()
+                    continue
+                self.held.lock_file = lock_file
+                return self
+            time.sleep(0.1)  # Все места заняты - ждем, пока какое-то освободится
+
+    def __exit__(self, *args):
+        self.held.lock_file.close()  # Закрытие файла снимает flock
+        return False
 
 
 ##РАБОТА С ТЕКСТОМ
-# Функция для проверки запроса на URL YT
-def is_youtube_url(url):
-    youtube_regex = (
-        r'(https?://)?(www\.)?'
-        '(youtube|youtu|youtube-nocookie)\.(com|be)/'
-        '(watch\?v=|embed/|v/|.+\?v=)?([^&=%\?]{11})')
-    youtube_match = re.match(youtube_regex, url)
-    return bool(youtube_match)
+YOUTUBE_REGEX = (
+    r'(https?://)?((www|m|music)\.)?'
+    r'(youtube|youtu|youtube-nocookie)\.(com|be)/'
+    r'(watch\?v=|embed/|v/|shorts/|.+[?&]v=)?(?P<id>[\w-]{11})')
+
+#ID видео из ссылки - единый ключ для кэшей, youtu.be/X, watch?v=X&t=10 и music.youtube.com дают одно и то же
+def get_video_id(url):
+    youtube_match = re.match(YOUTUBE_REGEX, url.strip())
+    if youtube_match:
+        return youtube_match.group('id')
+    return None
+
+def video_url(video_id):
+    return f'https://www.youtube.com/watch?v={video_id}'
    
 #Будем ломать слова для Саши(сокращение текста в кнопках)
 def compress_title(title, vowel_pct=DROP_VOWELS):
@@ -235,75 +944,732 @@ def format_duration(seconds):
     return f"{minutes:02d}:{sec:02d}"
     
 #изолируем
+@timed('sanitize')
 def sanitize(input_string):
     return re.sub(r'[^\w\s,.!?-]', '', input_string)
+
+#кириллические буквы, которые пишутся так же, как латинские (и наоборот)
+HOMOGLYPHS = str.maketrans('аеёокрсухмтвні', 'aeeokpcyxmtbhi')
+HOMOGLYPHS_BACK = str.maketrans('aeokpcyxmtbh', 'аеокрсухмтвн')
+
+#ключ кэша поиска: регистр, пунктуация, лишние пробелы и порядок слов не важны
+def normalize_query(keywords):
+    tokens = set()
+    for token in re.sub(r'[\W_]+', ' ', keywords.casefold()).split():
+        latin = len(re.findall('[a-z]', token))
+        cyrillic = len(re.findall('[а-яё]', token))
+        if latin and cyrillic:  # Слово набрано вперемешку - приводим к алфавиту большинства букв
+            token = token.translate(HOMOGLYPHS if latin >= cyrillic else HOMOGLYPHS_BACK)
+        tokens.add(token)
+    return ' '.join(sorted(tokens))
     
     
 ##ПОИСК И ЗАГРУЗКА МУЗЫКИ
-#поиск трека
-def search_music(username, keywords, search_amount=MAX_RESULTS):
+#долгоживущие экземпляры для поиска: плоское извлечение выдачи без разбора страницы каждого видео
+#YoutubeDL не потокобезопасен, поэтому каждый поиск берет свободный экземпляр из очереди
+#создаются по мере надобности, не больше SEARCH_EXTRACTORS, дальше поиск ждет освободившийся
+search_ydls = queue.Queue()
+search_ydls_created = 0
+search_ydls_lock = threading.Lock()
+
+@contextmanager
+def search_extractor():
+    global search_ydls_created
+    try:
+        ydl = search_ydls.get_nowait()
+    except queue.Empty:
+        with search_ydls_lock:
+            create = search_ydls_created < SEARCH_EXTRACTORS
+            if create:
+                search_ydls_created += 1
+        ydl = YDL_FACTORY({'extract_flat': 'in_playlist', 'quiet': True}) if create else search_ydls.get()
+    try:
+        yield ydl
+    finally:
+        search_ydls.put(ydl)
+
+#сырые результаты поиска начиная с позиции start, только нужные поля
+@timed('search')
+def fetch_search_page(keywords, start, count):
+    with search_extractor() as ydl:
+        info = ydl.extract_info(f'ytsearch{start + count}:{keywords}', download=False)
+    entries = list((info or {}).get('entries') or [])[start:]
+    return entries
+
+#догружаем выдачу, пока не наберется needed результатов или не кончится MAX_RESULTS
+def extend_search_results(keywords, results, fetched, needed):
+    results = list(results)
+    while len(results) < needed and fetched < MAX_RESULTS:
+        count = min(RESULTS_PAGES, MAX_RESULTS - fetched)
+        entries = fetch_search_page(keywords, fetched, count)
+        fetched = fetched + count if len(entries) == count else MAX_RESULTS  # Выдача закончилась раньше
+        seen = {item['webpage_url'] for item in results}  # Выдача могла прийти из кэша по похожему запросу
+        results += [
+            {
+                'title': e.get('title') or 'Unknown Title',
+                'webpage_url': video_url(e['id']),
+                'duration': int(e['duration'])
+                # Отсюда можно добавить любые другие данные, которые считаешь необходимыми
+            }
+            for e in entries if e.get('id') and e.get('duration') and e['duration'] <= MAX_DURATION
+            and video_url(e['id']) not in seen
+        ]
+    if results:  # Пустой или сбойный ответ YouTube не запоминаем, иначе запрос полгода ничего не находит
+        cache_search_results(keywords, results, fetched)
+    return results, fetched
+
+#поиск трека: сразу только первая страница, остальное - по кнопке ">>"
+def search_music(username, keywords, search_amount=RESULTS_PAGES):
     logging.info(f'Начинаем поиск музыки по ключевым словам: {keywords}')
-    cached_results = get_cached_search_results(keywords)
-    if cached_results is not None:
-        return cached_results
+    cached = get_cached_search_results(keywords)
+    if cached is not None:
+        return cached
+    results, fetched = extend_search_results(keywords, [], 0, search_amount)
+    if not results:
+        logging.error('Ничего не найдено.')
+        return None, fetched
+    logging.info('Нашли музыку по запросу: ' + results[0]['webpage_url'])
+    return results, fetched
+    
+#из полного info yt-dlp оставляем только то, что храним в кэше метаданных
+def video_meta_from_info(info):
+    return {
+        'id': info['id'],
+        'title': info.get('title', 'Unknown Title'),
+        'duration': info.get('duration') or 0,
+        'formats': [
+            {'format_id': f.get('format_id'), 'ext': f.get('ext'), 'acodec': f.get('acodec'), 'abr': f.get('abr')}
+            for f in info.get('formats') or [] if f.get('vcodec') == 'none'
+        ],
+    }
+
+#проверка видео перед скачиванием: метаданные из кэша или одно извлечение, info потом уйдет в fetch_audio
+@timed('probe')
+def probe_video(video_id):
+    meta = get_cached_video_meta(video_id)
+    if meta:
+        return meta, None
     ydl_opts = {
-        'default_search': f'ytsearch{search_amount}',
-        'noplaylist': True,
-        'quiet': True
-        }
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        info = ydl.extract_info(keywords, download=False)
-        if not info or 'entries' not in info or not info['entries']:
-            logging.error('Ничего не найдено.')
-            return None
+        'format': 'bestaudio/best',
+        'quiet': True,
+    }
+    with YDL_FACTORY(ydl_opts) as ydl:
+        info = ydl.sanitize_info(ydl.extract_info(video_url(video_id), download=False))
+    meta = video_meta_from_info(info)
+    cache_video_meta(meta)
+    return meta, info
+
+#скачивание без конвертации, выполняется в отдельном процессе пула download_pool
+def fetch_audio(url, info=None):
+    ydl_opts = {
+        # m4a (AAC) Telegram проигрывает как есть, поэтому при AUDIO_PASSTHROUGH он в приоритете
+        'format': 'bestaudio[ext=m4a]/bestaudio/best' if AUDIO_PASSTHROUGH else 'bestaudio/best',
+        'quiet': True,
+        'outtmpl': os.path.join(DOWNLOAD_DIR, '%(id)s.src.%(ext)s'),  # Шаблон временного имени файла
+    }
+    with YDL_FACTORY(ydl_opts) as ydl:
+        if info:  # Страница уже разобрана при проверке, повторно не извлекаем
+            info = ydl.process_ie_result(info, download=True)
         else:
-            logging.info('Нашли музыку по запросу: ' + info['entries'][0]['webpage_url'])
-            filtered_entries = [
-        {
-            'title': e['title'],
-            'webpage_url': e['webpage_url'],
-            'duration': e['duration']
-            # Отсюда можно добавить любые другие данные, которые считаешь необходимыми
-        }
-        for e in info['entries'] if e.get('duration', 0) <= 900
-    ]
-    cache_search_results(keywords, filtered_entries)
-    return filtered_entries
-    
-#загрузка и конвертация трека
-def download_and_convert_music(user_id, url):
+            info = ydl.extract_info(url, download=True)
+        return ydl.prepare_filename(info), video_meta_from_info(info), info.get('acodec') or ''
+
+#ffmpeg, одновременно не больше CONVERT_WORKERS процессов на все процессы бота: (секунды, процессорное время ffmpeg)
+def run_ffmpeg(args):
+    with convert_slots, timed('ffmpeg'):
+        started = time.monotonic()
+        # -nostdin: иначе ffmpeg читает терминал бота и в фоне останавливается по SIGTTIN, занимая слот навсегда
+        process = subprocess.Popen([FFMPEG, '-nostdin', '-y', '-loglevel', 'error', *args], stdin=subprocess.DEVNULL)
+        _, status, usage = os.wait4(process.pid, 0)  # wait4 отдает rusage именно этого процесса
+        process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, 'ffmpeg')
+    return time.monotonic() - started, usage.ru_utime + usage.ru_stime
+
+#качество mp3 по длительности трека, при большой очереди - на ступень ниже
+def choose_audio_tier(duration):
+    tiers = list(AUDIO_TIERS)
+    tier = next((name for limit, name in AUDIO_TIER_DURATIONS if duration <= limit), tiers[-1])
+    if download_jobs.qsize() >= AUDIO_HIGH_LOAD:
+        tier = tiers[min(tiers.index(tier) + 1, len(tiers) - 1)]
+    return tier
+
+#AAC перепаковывается в m4a без перекодирования, остальное (opus и т.п.) - в mp3 выбранного качества
+def prepare_audio(source_path, video_id, title, acodec, tier):
+    if AUDIO_PASSTHROUGH and acodec.startswith('mp4a'):
+        mode, ext = 'remux', 'm4a'
+        codec_args = ['-codec:a', 'copy', '-movflags', '+faststart']
+    else:
+        mode, ext = 'mp3', 'mp3'
+        codec_args = ['-codec:a', 'libmp3lame', '-b:a', f'{AUDIO_TIERS[tier]}k']
+    output_path = audio_path(video_id, ext)
+    done = False
+    try:
+        seconds, cpu_seconds = run_ffmpeg([
+            '-i', source_path, '-vn', *codec_args,
+            '-metadata', f'title={title}',  # Имя файла - ID видео, название Telegram возьмет из тега
+            output_path])
+        record_transcode(video_id, tier if mode == 'mp3' else 'source', mode,
+                         os.path.getsize(source_path), os.path.getsize(output_path), seconds, cpu_seconds)
+        done = True
+    finally:
+        # Исходник не нужен в любом случае, недописанный результат - только мусор до перезапуска
+        for file_path in (source_path,) if done else (source_path, output_path):
+            try:
+                os.remove(file_path)
+            except FileNotFoundError:
+                pass
+    return output_path, ext
+
+#время и размеры по качеству: в памяти для сводки и в базе (transcode_log) для сравнения
+transcode_stats = {}  #(качество, режим) -> счетчики
+transcode_lock = threading.Lock()
+
+def record_transcode(video_id, tier, mode, source_bytes, output_bytes, seconds, cpu_seconds):
+    logging.info(f'{video_id}: {mode}/{tier} {source_bytes} -> {output_bytes} байт за {seconds:.1f} с (CPU {cpu_seconds:.1f} с)')
+    with transcode_lock:
+        stats = transcode_stats.setdefault((tier, mode), {'count': 0, 'seconds': 0.0, 'cpu_seconds': 0.0, 'output_bytes': 0})
+        stats['count'] += 1
+        stats['seconds'] += seconds
+        stats['cpu_seconds'] += cpu_seconds
+        stats['output_bytes'] += output_bytes
+    db_writes.put(('''
+    INSERT INTO transcode_log (video_id, tier, mode, source_bytes, output_bytes, seconds, cpu_seconds)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', (video_id, tier, mode, source_bytes, output_bytes, seconds, cpu_seconds)))
+
+#загрузка и конвертация трека, progress(stage) сообщает о текущем этапе, info - результат probe_video
+def download_and_convert_music(user_id, url, progress=None, info=None):
     logging.info(f'def download_and_convert_music {url}')
-    rotate_files(DOWNLOAD_DIR)
     cached_file_path, cached_url = get_cached_file_path(url) 
     if cached_file_path:
-      url = cached_url or url  # Используем URL из кэша, если он есть
-      return cached_file_path
-    ydl_opts = {
-        'format': 'bestaudio/best',
-        'postprocessors': [{
-        'key': 'FFmpegExtractAudio',
-        'preferredcodec': 'mp3',
-        'preferredquality': '256',
-         }],
-         'quiet': True,
-         'outtmpl': '%(id)s.%(ext)s',  # Шаблон временного имени файла
-      }
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        info = ydl.extract_info(url, download=True)
-        logging.info(f'Музыка скачана по URL: {url}')
-        temp_file_path = ydl.prepare_filename(info) # Вытаскиваем заголовок и исполнителя для формирования итогового имени файла
-        title = safe_filename(info.get('title', 'Unknown Title'))
-        safe_mp3_filename = f'{title}.mp3'
-        temp_file_path = temp_file_path.removesuffix('.webm').removesuffix('.m4a').removesuffix('.mp4') + '.mp3' # расширение файла на основе postprocessor, уже должно быть mp3
-        new_file_path = os.path.join(os.path.dirname(temp_file_path), safe_mp3_filename) # Полный путь к файлу, куда будет переименован файл
-        if os.path.exists(temp_file_path):  # Проверка, существует ли скачанный файл по временному пути
-            os.rename(temp_file_path, new_file_path)  # Переименование оригинального файла в новое имя файла
-            cache_file_path(url, new_file_path, url)
-            logging.info(f'Файл успешно сохранен как {new_file_path}')
-        else:
-            logging.error(f'Скачанный файл {temp_file_path} не найден.')
+        video_id = os.path.splitext(os.path.basename(cached_file_path))[0]
+        if audio_store_touch(video_id):
+            count_event('file_cache_hit')
+            return cached_file_path
+        drop_cached_file_path(cached_file_path)  # Файла больше нет, скачиваем заново
+    count_event('file_cache_miss')
+    if progress:
+        progress('downloading')
+    with download_slots, timed('download'):  # Сам fetch_audio идет в другом процессе, его метрики сюда бы не попали
+        temp_file_path, meta, acodec = download_pool.submit(fetch_audio, url, info).result()
+    cache_video_meta(meta)
+    video_id, title = meta['id'], meta['title']
+    logging.info(f'Музыка скачана по URL: {url}')
+    if not os.path.exists(temp_file_path):  # Проверка, существует ли скачанный файл по временному пути
+        logging.error(f'Скачанный файл {temp_file_path} не найден.')
+        return None
+    if progress:
+        progress('converting')
+    new_file_path, ext = prepare_audio(temp_file_path, video_id, title, acodec, choose_audio_tier(meta['duration']))
+    cache_file_path(video_id, new_file_path, video_url(video_id))
+    audio_store_add(video_id, ext)
+    logging.info(f'Файл успешно сохранен как {new_file_path}')
+    return new_file_path
+
+
+##ОЧЕРЕДЬ ЗАГРУЗОК
+class UserQueueFull(queue.Full):
+    pass
+
+#справедливая очередь: у каждого пользователя своя очередь задач, пользователи обслуживаются по кругу,
+#так десяток ссылок от одного не задерживает остальных. Задачи администратора - вне очереди и без лимитов
+class FairQueue:
+    def __init__(self, maxsize, user_maxsize):
+        self.maxsize = maxsize
+        self.user_maxsize = user_maxsize
+        self.users = OrderedDict()  #ID пользователя (строкой) -> задачи, порядок - очередь обхода
+        self.size = 0
+        self.not_empty = threading.Condition()
+
+    def put_nowait(self, user_id, item):
+        key = str(user_id)
+        with self.not_empty:
+            items = self.users.get(key)
+            if key != ADMIN_USER_ID:
+                if items is not None and len(items) >= self.user_maxsize:
+                    raise UserQueueFull
+                if self.size >= self.maxsize:
+                    raise queue.Full
+            if items is None:
+                items = self.users[key] = deque()
+            items.append(item)
+            self.size += 1
+            self.not_empty.notify()
+
+    def get(self):
+        with self.not_empty:
+            while not self.size:
+                self.not_empty.wait()
+            key = ADMIN_USER_ID if ADMIN_USER_ID in self.users else next(iter(self.users))
+            items = self.users[key]
+            item = items.popleft()
+            self.size -= 1
+            if items:
+                self.users.move_to_end(key)  # Следующая задача этого пользователя - после задач остальных
+            else:
+                del self.users[key]
+            return item
+
+    def qsize(self):
+        return self.size
+
+#обработчики только ставят задачу в очередь, загрузкой занимаются рабочие потоки
+#пул и потоки - в каждом процессе свои, а сколько загрузок и ffmpeg идет одновременно, решают общие на все процессы места
+download_pool = ProcessPoolExecutor(max_workers=DOWNLOAD_WORKERS)
+download_slots = ProcessSlots('download', DOWNLOAD_WORKERS)
+convert_slots = ProcessSlots('convert', CONVERT_WORKERS)
+download_jobs = FairQueue(JOB_QUEUE_SIZE, USER_JOBS_MAX)
+inflight_downloads = {}  #ID видео -> Future текущей загрузки, чтобы одно видео не качалось дважды
+inflight_lock = threading.Lock()
+
+STATUS_TEXTS = {
+    'queued': 'Трек в очереди на загрузку...',
+    'waiting': 'Трек уже загружается, ждем...',
+    'checking': 'Проверяем видео...',
+    'downloading': 'Скачиваем трек...',
+    'converting': 'Обрабатываем аудио...',
+    'sending': 'Отправляем трек...',
+}
+
+def enqueue_download(chat_id, user_id, username, url, check_duration=False, record=False, result_index=None, prefetched=None):
+    status = bot.send_message(chat_id, STATUS_TEXTS['queued'])
+    job = {
+        'chat_id': chat_id,
+        'user_id': user_id,
+        'username': username,
+        'url': url,
+        'status_id': status.message_id,
+        'queued': time.monotonic(),  # для метрик времени ожидания в очереди
+        'check_duration': check_duration,  # для прямых ссылок проверяем длительность перед скачиванием
+        'record': record,  # записывать ли в историю загрузок
+        'result_index': result_index,  # номер трека в результатах поиска
+        'prefetched': prefetched,  # был ли трек скачан заранее (None - поиск без заранее скачивания)
+    }
+    try:
+        download_jobs.put_nowait(user_id, job)
+    except UserQueueFull:
+        count_event('user_queue_full')
+        set_job_status(job, f'У вас уже {USER_JOBS_MAX} треков в очереди, дождитесь их загрузки.')
+    except queue.Full:
+        count_event('queue_full')
+        set_job_status(job, 'Сейчас слишком много загрузок, попробуйте позже.')
+
+def set_job_status(job, text):
+    try:
+        bot.edit_message_text(text, job['chat_id'], job['status_id'])
+    except telebot.apihelper.ApiTelegramException as e:
+        logging.debug(f'Не удалось обновить статус загрузки: {e}')
+
+def process_download_job(job):
+    url = job['url']
+    info = None
+    if job['check_duration']:
+        set_job_status(job, STATUS_TEXTS['checking'])
+        try:
+            meta, info = probe_video(get_video_id(url))
+        except yt_dlp.utils.DownloadError:
+            # Если не удалось получить информацию о видео
+            set_job_status(job, "Не удалось получить информацию о видео.")
+            return
+        if meta['duration'] > MAX_LONG:  # продолжительность в секундах
+            # Если видео длиннее 12 минут
+            set_job_status(job, "Видео длиннее 12 минут и не может быть обработано.")
+            return
+    future, owner = claim_download(url)
+    if owner:
+        run_claimed_download(
+            future, job['user_id'], url, progress=lambda stage: set_job_status(job, STATUS_TEXTS[stage]), info=info)
+    else:
+        # Загрузка уже идет для другого чата, результат придет в колбэк и поток освободится
+        set_job_status(job, STATUS_TEXTS['waiting'])
+    future.add_done_callback(lambda done: finish_download_job(job, done))
+
+#единственная загрузка на видео: (future, True) - качаем сами, (future, False) - ждем чужую
+def claim_download(url):
+    key = get_video_id(url) or url
+    with inflight_lock:
+        future = inflight_downloads.get(key)
+        if future is not None:
+            return future, False
+        future = Future()
+        inflight_downloads[key] = future
+        return future, True
+
+def run_claimed_download(future, user_id, url, progress=None, info=None):
+    error = None
+    try:
+        with video_file_lock(get_video_id(url)):  # Другие процессы бота тоже могут качать это видео
+            file_path = download_and_convert_music(user_id, url, progress, info)
+    except Exception as e:
+        error = e
+    with inflight_lock:
+        inflight_downloads.pop(get_video_id(url) or url, None)
+    if error:
+        future.set_exception(error)  # Ошибку получат все ожидающие, в кэш ничего не попадет
+    else:
+        future.set_result(file_path)
+
+def finish_download_job(job, future):
+    chat_id = job['chat_id']
+    url = job['url']
+    try:
+        file_path = future.result()
+    except Exception as e:
+        logging.error(f'Ошибка загрузки {url}: {e}')
+        count_event('download_error')
+        file_path = None
+    try:
+        deliver_download(job, file_path)
+    except Exception as e:
+        logging.error(f'Не удалось отправить трек {url} в чат {chat_id}: {e}')
+        count_event('send_error')
+    observe('job', time.monotonic() - job['queued'])  # От нажатия до трека в чате
+
+def deliver_download(job, file_path):
+    chat_id = job['chat_id']
+    url = job['url']
+    if job['record']:
+        db_add_download(job['user_id'], job['username'], url, file_path or '',
+                        job['result_index'], job['prefetched'])
+    if file_path:  # Если файл успешно скачан
+        set_job_status(job, STATUS_TEXTS['sending'])
+        if not send_cached_music(chat_id, url):  # Кто-то из ожидавших мог уже загрузить файл в Telegram
+            send_music(chat_id, file_path, url)  # Отправляем музыку пользователю
+        bot.delete_message(chat_id, job['status_id'])
+    else:  # Если возникла ошибка при скачивании
+        set_job_status(job, "Не удалось скачать трек.")
+
+def download_worker():
+    while True:
+        job = download_jobs.get()
+        observe('queue_wait', time.monotonic() - job['queued'])
+        try:
+            process_download_job(job)
+        except Exception as e:
+            logging.error(f'Ошибка обработки задачи загрузки {job["url"]}: {e}')
+
+#потоков столько, чтобы были заняты и сеть, и ffmpeg
+def start_download_workers():
+    for _ in range(DOWNLOAD_WORKERS + CONVERT_WORKERS):
+        threading.Thread(target=download_worker, daemon=True).start()
+    if PREFETCH_TOP_K:
+        for _ in range(PREFETCH_WORKERS):
+            threading.Thread(target=prefetch_worker, daemon=True).start()
+
+
+##ОГРАНИЧЕНИЕ СКОРОСТИ
+#ведро токенов: rate токенов в секунду, не больше capacity про запас
+class TokenBucket:
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated', 'paused_until', 'lock')
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    #забираем токен: 0 - получилось, иначе сколько секунд ждать
+    def take(self, tokens=1):
+        with self.lock:
+            now = time.monotonic()
+            if now < self.paused_until:
+                return self.paused_until - now
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return 0
+            return (tokens - self.tokens) / self.rate
+
+    def wait(self, tokens=1):
+        while True:
+            delay = self.take(tokens)
+            if not delay:
+                return
+            time.sleep(delay)
+
+    #никому не выдавать токены seconds секунд (например, после 429 от Telegram)
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+#лимиты пользователей: поиски и загрузки считаются отдельно
+user_buckets = OrderedDict()  #(вид, ID пользователя) -> TokenBucket, от давно использованных к недавним
+user_buckets_lock = threading.Lock()
+
+#0 - можно, иначе сколько секунд подождать
+def user_wait(user_id, kind):
+    if str(user_id) == ADMIN_USER_ID:
+        return 0
+    delay = user_bucket(user_id, kind).take()
+    if delay:
+        count_event(f'{kind}_throttled')
+    return delay
+
+def user_bucket(user_id, kind):
+    with user_buckets_lock:
+        bucket = user_buckets.pop((kind, user_id), None)
+        if bucket is None:
+            per_minute, burst = USER_RATE_LIMITS[kind]
+            bucket = TokenBucket(per_minute / 60, burst)
+        user_buckets[(kind, user_id)] = bucket
+        if len(user_buckets) > USER_BUCKETS_MAX:
+            user_buckets.popitem(last=False)
+    return bucket
+
+def throttled_text(delay):
+    return f"Слишком много запросов, подождите {int(delay) + 1} с."
+
+
+##ЗАРАНЕЕ СКАЧИВАНИЕ
+#пока пользователь выбирает, первые результаты поиска качаются в фоне теми же загрузками, что и по кнопке:
+#нажатие на трек, который еще качается, просто ждет эту загрузку. Задачи пользователей всегда важнее
+prefetch_jobs = queue.Queue()  #(ID поиска, ID видео)
+prefetch_pending = {}  #ID поиска -> ID видео, которые еще ждут очереди
+prefetch_ready = {}  #ID видео -> размер, скачаны заранее и еще никем не выбраны
+prefetch_lock = threading.Lock()
+prefetch_bucket = TokenBucket(PREFETCH_PER_MINUTE / 60, PREFETCH_PER_MINUTE)
+prefetch_stats = {'queued': 0, 'downloaded': 0, 'cancelled': 0, 'hit': 0, 'inflight': 0, 'miss': 0}
+
+def schedule_prefetch(session):
+    if not PREFETCH_TOP_K:
+        return
+    video_ids = [track.video_id for track in session.tracks[:PREFETCH_TOP_K]]
+    with prefetch_lock:
+        prefetch_pending[session.search_id] = set(video_ids)
+        prefetch_stats['queued'] += len(video_ids)
+    for video_id in video_ids:
+        prefetch_jobs.put((session.search_id, video_id))
+
+def cancel_prefetch(search_id):
+    with prefetch_lock:
+        pending = prefetch_pending.pop(search_id, None) or ()
+        prefetch_stats['cancelled'] += len(pending)
+
+#пользователь выбрал трек: остальное по этому поиску больше не нужно
+#возвращает, был ли трек скачан заранее, None - поиск без заранее скачивания
+def prefetch_pick(search_id, video_id):
+    with prefetch_lock:
+        pending = prefetch_pending.pop(search_id, None)
+        ready = prefetch_ready.pop(video_id, None) is not None
+        if pending is None and not ready:
             return None
-        return new_file_path
+        prefetch_stats['cancelled'] += len(pending or ())
+        if ready:
+            prefetch_stats['hit'] += 1
+        elif video_id in inflight_downloads:  # Еще качается - ждать меньше, чем с нуля
+            prefetch_stats['inflight'] += 1
+        else:
+            prefetch_stats['miss'] += 1
+    return ready
+
+#бюджет: очередь пользователей пуста, CPU не загружен, место и трафик не исчерпаны
+def prefetch_allowed():
+    if download_jobs.qsize() or os.getloadavg()[0] > PREFETCH_MAX_LOAD:
+        return False
+    with prefetch_lock:
+        ready = dict(prefetch_ready)
+    for video_id in ready:
+        if not get_cached_file_path(video_url(video_id))[0]:  # Файл уже вытеснен ротацией
+            with prefetch_lock:
+                prefetch_ready.pop(video_id, None)
+            ready.pop(video_id)
+    if sum(ready.values()) >= PREFETCH_MAX_BYTES:
+        return False
+    return not prefetch_bucket.take()
+
+def prefetch_video(search_id, video_id):
+    while True:
+        with prefetch_lock:
+            if video_id not in prefetch_pending.get(search_id, ()):
+                return  # Пользователь уже выбрал трек
+        if not session_alive(search_id, PREFETCH_MAX_AGE):  # Пользователь ушел, кнопки уже не нажмет
+            cancel_prefetch(search_id)
+            return
+        if prefetch_allowed():
+            break
+        time.sleep(1)
+    with prefetch_lock:
+        prefetch_pending.get(search_id, set()).discard(video_id)
+    url = video_url(video_id)
+    if get_cached_file_id(url) or get_cached_file_path(url)[0]:
+        return
+    future, owner = claim_download(url)
+    if not owner:
+        return
+    run_claimed_download(future, None, url)
+    file_path = future.result()  # Ошибку загрузки запишет prefetch_worker
+    if not file_path:  # download_and_convert_music не нашел скачанный файл, в заранее скачанные не записываем
+        return
+    with prefetch_lock:
+        prefetch_ready[video_id] = os.path.getsize(file_path)
+        prefetch_stats['downloaded'] += 1
+
+def prefetch_worker():
+    while True:
+        search_id, video_id = prefetch_jobs.get()
+        try:
+            prefetch_video(search_id, video_id)
+        except Exception as e:
+            logging.error(f'Ошибка заранее скачивания {video_id}: {e}')
+
+def prefetch_stats_text():
+    with prefetch_lock:
+        stats = dict(prefetch_stats)
+        unused = len(prefetch_ready)
+    picked = stats['hit'] + stats['inflight'] + stats['miss']
+    return (
+        f"Заранее скачивание: в очередь {stats['queued']}, скачано {stats['downloaded']}, отменено {stats['cancelled']}, "
+        f"не выбрано {unused}; выборов {picked}: готово {stats['hit']}, еще качалось {stats['inflight']}, "
+        f"промахов {stats['miss']}, доля попаданий {stats['hit'] / picked if picked else 0:.0%}")
+
+
+##СТАТИСТИКА
+#текущие размеры очередей и т.п. - снимаются в момент запроса
+def stats_gauges():
+    return {
+        'download_queue': download_jobs.qsize(),
+        'prefetch_queue': prefetch_jobs.qsize(),
+        'db_write_queue': db_writes.qsize(),
+        'inflight_downloads': len(inflight_downloads),
+        'sessions': len(sessions),
+    }
+
+def stats_snapshot():
+    with stats_lock:
+        stages = {stage: dict(stats, buckets=list(stats['buckets'])) for stage, stats in stage_stats.items()}
+        events = dict(event_counts)
+    with prefetch_lock:
+        events.update({f'prefetch_{name}': count for name, count in prefetch_stats.items()})
+    with transcode_lock:
+        transcodes = {key: dict(stats) for key, stats in transcode_stats.items()}
+    return stages, events, transcodes
+
+#сводка для администратора (/stats)
+def stats_text():
+    stages, events, transcodes = stats_snapshot()
+    lines = ['Этапы (раз, p50, p95, среднее, ошибок):']
+    for stage, stats in sorted(stages.items()):
+        lines.append(
+            f"{stage}: {stats['count']}, {stage_quantile(stats, 0.5):g} с, {stage_quantile(stats, 0.95):g} с, "
+            f"{stats['sum'] / stats['count']:.3f} с, {stats['errors']}")
+    lines.append('События: ' + (', '.join(f'{name} {count}' for name, count in sorted(events.items())) or 'нет'))
+    lines.append('Очереди: ' + ', '.join(f'{name} {value}' for name, value in stats_gauges().items()))
+    for (tier, mode), stats in sorted(transcodes.items()):
+        lines.append(
+            f"Аудио {mode}/{tier}: {stats['count']} файлов, в среднем {stats['seconds'] / stats['count']:.1f} с, "
+            f"CPU {stats['cpu_seconds'] / stats['count']:.1f} с, {stats['output_bytes'] // stats['count'] // 1024} КБ")
+    return '\n'.join(lines)
+
+#то же в текстовом формате Prometheus
+def metrics_text():
+    stages, events, transcodes = stats_snapshot()
+    lines = ['# TYPE refinder_stage_seconds histogram']
+    for stage, stats in sorted(stages.items()):
+        seen = 0
+        for bound, count in zip(STATS_BUCKETS + ('+Inf',), stats['buckets']):
+            seen += count
+            lines.append(f'refinder_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {seen}')
+        lines.append(f'refinder_stage_seconds_sum{{stage="{stage}"}} {stats["sum"]}')
+        lines.append(f'refinder_stage_seconds_count{{stage="{stage}"}} {stats["count"]}')
+    lines.append('# TYPE refinder_stage_errors_total counter')
+    lines.extend(f'refinder_stage_errors_total{{stage="{stage}"}} {stats["errors"]}' for stage, stats in sorted(stages.items()))
+    lines.append('# TYPE refinder_events_total counter')
+    lines.extend(f'refinder_events_total{{event="{name}"}} {count}' for name, count in sorted(events.items()))
+    for metric, field in (('seconds', 'seconds'), ('cpu_seconds', 'cpu_seconds'), ('files', 'count')):
+        lines.append(f'# TYPE refinder_transcode_{metric}_total counter')
+        lines.extend(f'refinder_transcode_{metric}_total{{tier="{tier}",mode="{mode}"}} {stats[field]}'
+                     for (tier, mode), stats in sorted(transcodes.items()))
+    lines.append('# TYPE refinder_gauge gauge')
+    lines.extend(f'refinder_gauge{{name="{name}"}} {value}' for name, value in stats_gauges().items())
+    return '\n'.join(lines) + '\n'
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = metrics_text().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_stats_server(port):
+    server = ThreadingHTTPServer((WEBHOOK_HOST, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info(f'Метрики Prometheus: http://{WEBHOOK_HOST}:{port}/metrics')
+
+#сэмплирующий профилировщик: включается командой /profile, раз в PROFILER_INTERVAL снимает стеки всех потоков
+profiler = {'stop': None, 'samples': 0, 'idle': 0, 'own': Counter(), 'total': Counter()}
+profiler_lock = threading.Lock()
+PROFILER_IDLE_FILES = ('threading.py', 'queue.py', 'selectors.py', 'socketserver.py')  #поток просто ждет работу
+
+def frame_label(frame):
+    code = frame.f_code
+    return f'{os.path.basename(code.co_filename)}:{code.co_firstlineno} {code.co_name}'
+
+def profiler_loop(stop):
+    me = threading.get_ident()
+    while not stop.wait(PROFILER_INTERVAL):
+        frames = sys._current_frames()
+        with profiler_lock:
+            for thread_id, frame in frames.items():
+                if thread_id == me:
+                    continue
+                profiler['samples'] += 1
+                if os.path.basename(frame.f_code.co_filename) in PROFILER_IDLE_FILES:
+                    profiler['idle'] += 1
+                    continue
+                profiler['own'][frame_label(frame)] += 1
+                seen = set()  # Рекурсия не должна считаться дважды
+                while frame is not None:
+                    label = frame_label(frame)
+                    if label not in seen:
+                        seen.add(label)
+                        profiler['total'][label] += 1
+                    frame = frame.f_back
+
+def start_profiler():
+    with profiler_lock:
+        if profiler['stop'] is not None:
+            return False
+        profiler.update(stop=threading.Event(), samples=0, idle=0, own=Counter(), total=Counter())
+        stop = profiler['stop']
+    threading.Thread(target=profiler_loop, args=(stop,), daemon=True).start()
+    return True
+
+def stop_profiler():
+    with profiler_lock:
+        stop, profiler['stop'] = profiler['stop'], None
+    if stop is None:
+        return False
+    stop.set()
+    return True
+
+def profiler_text(top=10):
+    with profiler_lock:
+        samples, idle = profiler['samples'], profiler['idle']
+        own, total = profiler['own'].most_common(top), profiler['total'].most_common(top)
+        running = profiler['stop'] is not None
+    if not samples:
+        return 'Профилировщик еще ничего не собрал. Включить: /profile on'
+    busy = samples - idle
+    lines = [f"Профилировщик {'работает' if running else 'остановлен'}: {samples} сэмплов, ожидание {idle / samples:.0%}",
+             'Сами по себе:']
+    lines.extend(f'{count / busy:.0%} {label}' for label, count in own)
+    lines.append('Вместе с вызванными:')
+    lines.extend(f'{count / busy:.0%} {label}' for label, count in total)
+    return '\n'.join(lines)
 
 
 ###БОТ И ДЕЙСТВИЯ
@@ -312,7 +1678,6 @@ def send_welcome(chat_id):
     bot.send_message(chat_id, welcome_text)
     
 #старт:
-@bot.message_handler(commands=['start'])
 def start(message):
     user_id = message.from_user.id
     username = message.from_user.username
@@ -324,122 +1689,438 @@ def start(message):
 
 ##OVERDRIVE
 #объявления
-@bot.message_handler(commands=['broadcast'])
 def handle_broadcast_command(message):
     if str(message.from_user.id) == ADMIN_USER_ID:
         args = message.text.split(maxsplit=1)  # Разбиваем сообщение на части
         if len(args) > 1:
             # Вторая часть - это текст сообщения, который нужно отправить
             text = args[1]
-            broadcast_message(text)
-            bot.reply_to(message, "Сообщение отправлено всем пользователям.")
+            broadcast_id, total = broadcast_message(text)
+            bot.reply_to(message, f"Рассылка #{broadcast_id} запущена: {total} получателей. Ход рассылки: /broadcast_status")
         else:
             bot.reply_to(message, "Пожалуйста, укажите текст сообщения после команды.")
     else:
         bot.reply_to(message, "У вас нет прав использовать эту команду.")
 
+def handle_broadcast_status_command(message):
+    if str(message.from_user.id) != ADMIN_USER_ID:
+        bot.reply_to(message, "У вас нет прав использовать эту команду.")
+        return
+    bot.reply_to(message, broadcast_status_text())
+
+#статистика кэша поиска
+def handle_cache_stats_command(message):
+    if str(message.from_user.id) != ADMIN_USER_ID:
+        bot.reply_to(message, "У вас нет прав использовать эту команду.")
+        return
+    stats = search_cache_stats()
+    bot.reply_to(message, (
+        f"Кэш поиска: точных попаданий {stats['exact']}, "
+        f"похожих {stats['fuzzy']}, промахов {stats['miss']}, "
+        f"доля попаданий {search_cache_hit_rate():.0%}\n{prefetch_stats_text()}"))
+
+#время этапов, события, очереди и обработка аудио
+def handle_stats_command(message):
+    if str(message.from_user.id) != ADMIN_USER_ID:
+        bot.reply_to(message, "У вас нет прав использовать эту команду.")
+        return
+    bot.reply_to(message, stats_text())
+
+#/profile on - включить, /profile off - выключить и показать, /profile - показать, не выключая
+def handle_profile_command(message):
+    if str(message.from_user.id) != ADMIN_USER_ID:
+        bot.reply_to(message, "У вас нет прав использовать эту команду.")
+        return
+    args = message.text.split()
+    action = args[1] if len(args) > 1 else ''
+    if action == 'on':
+        bot.reply_to(message, "Профилировщик включен." if start_profiler() else "Профилировщик уже работает.")
+        return
+    if action == 'off':
+        stop_profiler()
+    bot.reply_to(message, profiler_text())
+
+#рассылка идет в фоне: получатели и их статус в базе, после перезапуска продолжается с неотправленных
+broadcast_bucket = TokenBucket(BROADCAST_RATE, 1)  #общий лимит на все потоки рассылки, без пачек в начале
+broadcast_runs = {}  #ID рассылки -> счетчики для /broadcast_status
+broadcast_lock = threading.Lock()
+
 def broadcast_message(text):
-    chat_ids = load_chat_ids()
-    for chat_id in chat_ids:
+    with db_lock:
+        cursor = db_conn.cursor()
+        db_write_users(cursor)  # Чтобы в рассылку попали и только что пришедшие, не дожидаясь всей очереди истории
+        cursor.execute('INSERT INTO broadcasts (text) VALUES (?)', (text,))
+        broadcast_id = cursor.lastrowid
+        cursor.execute('INSERT INTO broadcast_recipients (broadcast_id, chat_id) SELECT ?, id FROM users', (broadcast_id,))
+        total = cursor.rowcount
+        db_conn.commit()
+    start_broadcast(broadcast_id, text)
+    return broadcast_id, total
+
+#незавершенные рассылки продолжаются при старте бота
+def resume_broadcasts():
+    conn = db_connect()
+    unfinished = conn.execute("SELECT id, text FROM broadcasts WHERE status = 'running'").fetchall()
+    conn.close()
+    for broadcast_id, text in unfinished:
+        logging.info(f'Продолжаем рассылку #{broadcast_id}')
+        start_broadcast(broadcast_id, text)
+
+def start_broadcast(broadcast_id, text):
+    conn = db_connect()
+    counts = dict(conn.execute(
+        'SELECT status, COUNT(*) FROM broadcast_recipients WHERE broadcast_id = ? GROUP BY status', (broadcast_id,)))
+    conn.close()
+    run = {
+        'started': time.monotonic(),
+        'total': sum(counts.values()),
+        'sent': counts.get('sent', 0),
+        'failed': counts.get('failed', 0),
+        'sent_now': 0,  # отправлено в этом запуске, для скорости
+        'retries': 0,
+        'finished': None,
+    }
+    with broadcast_lock:
+        broadcast_runs[broadcast_id] = run
+    recipients = queue.Queue(maxsize=BROADCAST_SENDERS * 100)
+    threading.Thread(target=broadcast_producer, args=(broadcast_id, recipients), daemon=True).start()
+    senders = [threading.Thread(target=broadcast_sender, args=(broadcast_id, text, recipients, run), daemon=True)
+               for _ in range(BROADCAST_SENDERS)]
+    for sender in senders:
+        sender.start()
+    threading.Thread(target=broadcast_finisher, args=(broadcast_id, senders, run), daemon=True).start()
+
+#получатели читаются из базы потоком, а не списком целиком
+def broadcast_producer(broadcast_id, recipients):
+    conn = db_connect()
+    try:
+        for (chat_id,) in conn.execute(
+                "SELECT chat_id FROM broadcast_recipients WHERE broadcast_id = ? AND status = 'pending'", (broadcast_id,)):
+            recipients.put(chat_id)
+    finally:
+        conn.close()
+        for _ in range(BROADCAST_SENDERS):
+            recipients.put(None)  # Сигнал потокам-отправителям, что получателей больше нет
+
+def broadcast_sender(broadcast_id, text, recipients, run):
+    while True:
+        chat_id = recipients.get()
+        if chat_id is None:
+            return
+        status, attempts, error = send_broadcast_message(chat_id, text, run)
+        with broadcast_lock:
+            run[status] += 1
+            if status == 'sent':
+                run['sent_now'] += 1
+        db_writes.put(('UPDATE broadcast_recipients SET status = ?, attempts = ?, error = ? WHERE broadcast_id = ? AND chat_id = ?',
+                       (status, attempts, error, broadcast_id, chat_id)))
+
+#одно сообщение с повторами: при 429 ждем retry_after (и вся рассылка тоже), при сбоях сети - нарастающая пауза
+def send_broadcast_message(chat_id, text, run):
+    error = None
+    for attempt in range(1, BROADCAST_MAX_ATTEMPTS + 1):
+        broadcast_bucket.wait()
         try:
             bot.send_message(chat_id, text)
+            return 'sent', attempt, None
+        except telebot.apihelper.ApiTelegramException as e:
+            error = e.description
+            if e.error_code == 429:
+                retry_after = e.result_json.get('parameters', {}).get('retry_after', 1)
+                broadcast_bucket.pause(retry_after)
+            elif e.error_code < 500:  # Бот заблокирован, чат удален и т.п. - повторять бесполезно
+                return 'failed', attempt, error
+            else:
+                time.sleep(2 ** attempt)
         except Exception as e:
-            logging.error(f"Не удалось отправить сообщение пользователю {chat_id}: {e}")
+            error = str(e)
+            time.sleep(2 ** attempt)
+        with broadcast_lock:
+            run['retries'] += 1
+    logging.error(f"Не удалось отправить сообщение пользователю {chat_id}: {error}")
+    return 'failed', BROADCAST_MAX_ATTEMPTS, error
+
+def broadcast_finisher(broadcast_id, senders, run):
+    for sender in senders:
+        sender.join()
+    with broadcast_lock:
+        run['finished'] = time.monotonic()
+    db_writes.put(("UPDATE broadcasts SET status = 'done', finished = CURRENT_TIMESTAMP WHERE id = ?", (broadcast_id,)))
+    logging.info(f"Рассылка #{broadcast_id} завершена: отправлено {run['sent']}, ошибок {run['failed']}")
+
+def broadcast_status_text():
+    with broadcast_lock:
+        runs = {broadcast_id: dict(run) for broadcast_id, run in broadcast_runs.items()}
+    if not runs:
+        return "С момента запуска рассылок не было."
+    lines = []
+    for broadcast_id, run in sorted(runs.items()):
+        elapsed = (run['finished'] or time.monotonic()) - run['started']
+        state = 'завершена' if run['finished'] else 'идет'
+        lines.append(
+            f"#{broadcast_id} {state}: отправлено {run['sent']} из {run['total']}, ошибок {run['failed']}, "
+            f"повторов {run['retries']}, {run['sent_now'] / elapsed if elapsed else 0:.1f} сообщ./с")
+    return '\n'.join(lines)
 #    
 #запрос
-@bot.message_handler(content_types=['text'])
+@timed('message')
 def text(message):
     chat_id = message.chat.id
     user_id = message.from_user.id
     username = message.from_user.username 
     keywords = sanitize(message.text)
+    # Проверям, является ли текст сообщения ссылкой на YouTube (до sanitize, он вырезает / и =)
+    video_id = get_video_id(message.text)
+    delay = user_wait(user_id, 'download' if video_id else 'search')
+    if delay:  # Отказ сразу, без поиска и без записи в историю
+        bot.send_message(chat_id, throttled_text(delay))
+        return
     db_add_search(user_id, username, keywords)
-    # Проверям, является ли текст сообщения ссылкой на YouTube
-    if is_youtube_url(keywords):
-        # Проверяем длительность видео перед скачиванием
-        ydl_opts = {
-            'format': 'bestaudio/best',
-            'quiet': True,
-        }
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            try:
-                info = ydl.extract_info(keywords, download=False)
-                video_duration = info.get('duration', 0)  # продолжительность в секундах
-            except yt_dlp.utils.DownloadError:
-                # Если не удалось получить информацию о видео
-                bot.send_message(chat_id, "Не удалось получить информацию о видео.")
-                return
-        if video_duration > 720:
-            # Если видео длиннее 12 минут
-            bot.send_message(chat_id, "Видео длиннее 12 минут и не может быть обработано.")
-        else:
-            # Если видео подходит по длительности, скачиваем и конвертируем
-            file_path = download_and_convert_music(username, keywords)
-            if file_path:
-                # Если файл успешно скачан, отправляем музыку
-                send_music(chat_id, file_path)
-            else:
-                # Если возникла ошибка при скачивании
-                bot.send_message(chat_id, "Не удалось скачать трек.")
+    if video_id:
+        url = video_url(video_id)  # Разные формы ссылки сводим к одной
+        # Если трек уже загружался в Telegram, отправляем его по file_id
+        if send_cached_music(chat_id, url):
+            return
+        # Длительность проверяется в рабочем потоке перед скачиванием
+        enqueue_download(chat_id, user_id, username, url, check_duration=True)
     else:
         # Обрабатываем остальной текст как поиск
-        results = search_music(username, keywords)
+        started = time.monotonic()
+        results, fetched = search_music(username, keywords)
         if results:
-            requests[chat_id] = results
-            send_results_page(chat_id, results)  # Отправляем первую страницу результатов
+            session = new_session(chat_id, keywords, results, fetched)
+            send_results_page(chat_id, session)  # Отправляем первую страницу результатов
+            schedule_prefetch(session)  # Пока пользователь выбирает, качаем первые треки
+            logging.info(f'Время до первой клавиатуры: {time.monotonic() - started:.2f} с ({keywords})')
         else:
             bot.send_message(chat_id, "К сожалению, ничего не найдено. Попробуйте другой запрос.")  
     
 #отправка сообщений с результатами поиска
-def send_results_page(chat_id, results, page=1, results_per_page=RESULTS_PAGES):
-    total_pages = (len(results) + results_per_page - 1) // results_per_page
+#в callback_data - ID поиска и номер, так старые клавиатуры не зависят от новых поисков в чате
+def send_results_page(chat_id, session, page=1, results_per_page=RESULTS_PAGES):
+    bot.send_message(chat_id, "Выберите трек для скачивания:", reply_markup=results_keyboard(session, page, results_per_page))
+
+#клавиатура страницы результатов, отдельно от отправки - ее строит и bench_search.py
+def results_keyboard(session, page=1, results_per_page=RESULTS_PAGES):
+    tracks = session.tracks
+    total_pages = (len(tracks) + results_per_page - 1) // results_per_page
     page = max(1, min(page, total_pages))
-    page_results = results[(page - 1) * results_per_page: page * results_per_page]
+    page_tracks = tracks[(page - 1) * results_per_page: page * results_per_page]
     keyboard = types.InlineKeyboardMarkup(row_width=1)
     #кнопки для каждой песни
-    for i, item in enumerate(page_results, start=(page - 1) * results_per_page):
-        duration = format_duration(item['duration']) if 'duration' in item else 'Unknown'
-        title = trim_or_compress_title(item.get('title', 'Unknown Title'))
+    for i, track in enumerate(page_tracks, start=(page - 1) * results_per_page):
+        duration = format_duration(track.duration) if track.duration else 'Unknown'
+        title = trim_or_compress_title(track.title or 'Unknown Title')
         button_text = f"{i + 1}. {title} [{duration}]"
-        keyboard.add(types.InlineKeyboardButton(button_text, callback_data=f'download_{i + 1}')) 
+        keyboard.add(types.InlineKeyboardButton(button_text, callback_data=f'd:{session.search_id}:{i + 1}'))
     #кнопки для навигации по страницам
     navigation_buttons = []
     if page > 1:
-        navigation_buttons.append(types.InlineKeyboardButton("<<", callback_data=f'page_{page-1}'))
-    if page < total_pages:
-        navigation_buttons.append(types.InlineKeyboardButton(">>", callback_data=f'page_{page+1}'))
+        navigation_buttons.append(types.InlineKeyboardButton("<<", callback_data=f'p:{session.search_id}:{page-1}'))
+    if page < total_pages or session.has_more():  # Следующая страница может быть еще не загружена
+        navigation_buttons.append(types.InlineKeyboardButton(">>", callback_data=f'p:{session.search_id}:{page+1}'))
     if navigation_buttons:
         keyboard.row(*navigation_buttons)
-    bot.send_message(chat_id, "Выберите трек для скачивания:", reply_markup=keyboard)
+    return keyboard
     
+#кнопки до перехода на ID поиска или от устаревшего поиска
+def query_outdated(call):
+    bot.answer_callback_query(call.id, "Результаты поиска устарели, повторите запрос.")
+
+def callback_session(call):
+    _, search_id, number = call.data.split(':')
+    session = get_session(search_id)
+    if session is None:
+        query_outdated(call)
+    return session, int(number)
+
 #страницы
-@bot.callback_query_handler(func=lambda call: call.data.startswith('page_'))
+@timed('callback_page')
 def query_page(call):
     # Обработчик запросов на переключение страниц с результатами поиска
-    page_num = int(call.data.split('_')[1])
+    session, page_num = callback_session(call)
+    if session is None:
+        return
     chat_id = call.message.chat.id
-    send_results_page(chat_id, requests[chat_id], page=page_num)
+    if len(session.tracks) < page_num * RESULTS_PAGES and session.has_more():
+        delay = user_wait(call.from_user.id, 'search')  # Догрузка страницы - это новый поиск
+        if delay:
+            bot.answer_callback_query(call.id, throttled_text(delay))
+            return
+        results, fetched = extend_search_results(
+            session.keywords, session.results(), session.fetched, page_num * RESULTS_PAGES)
+        session.set_results(results, fetched)
+        save_session(session)
+    send_results_page(chat_id, session, page=page_num)
 
 #загрузка
-@bot.callback_query_handler(func=lambda call: call.data.startswith('download_'))
+@timed('callback_download')
 def callback_query(call):
     user_id = call.from_user.id  # Получаем user_id из объекта call
     chat_id = call.message.chat.id
     username = call.from_user.username
-    index = int(call.data.split('_')[1]) - 1  # Получаем индекс трека
-    url = requests[chat_id][index]['webpage_url']  # Получаем URL для скачивания
-    file_path = download_and_convert_music(user_id, url)  # Скачиваем и конвертируем файл 
-    db_add_download(user_id, username, url, file_path)
-    if file_path:  # Если файл успешно скачан
-        send_music(chat_id, file_path)  # Отправляем музыку пользователю
-    else:  # Если возникла ошибка при скачивании
-        bot.send_message(chat_id, "Не удалось скачать трек.")  # Отправляем сообщение об ошибке
+    session, number = callback_session(call)
+    if session is None or not 0 < number <= len(session.tracks):
+        return
+    delay = user_wait(user_id, 'download')
+    if delay:
+        bot.answer_callback_query(call.id, throttled_text(delay))
+        return
+    video_id = session.tracks[number - 1].video_id
+    url = video_url(video_id)  # Получаем URL для скачивания
+    prefetched = prefetch_pick(session.search_id, video_id)
+    if send_cached_music(chat_id, url):  # Трек уже есть в Telegram, файл не нужен
+        cached_file_path, _ = get_cached_file_path(url)
+        db_add_download(user_id, username, url, cached_file_path or '', number, prefetched)
+        return
+    # Скачиваем и конвертируем в рабочем потоке
+    enqueue_download(chat_id, user_id, username, url, record=True, result_index=number, prefetched=prefetched)
         
-def send_music(chat_id, filename):
+@timed('upload')
+def send_music(chat_id, filename, url=None):
     logging.info(f'Начинаем отправку музыки в чат {chat_id} по имени файла: {filename}')
     with open(filename, 'rb') as audio:
-        bot.send_audio(chat_id, audio)
+        sent = bot.send_audio(chat_id, audio)
+    if url and sent.audio:  # Запоминаем file_id, чтобы больше не загружать этот файл
+        cache_file_id(url, sent.audio.file_id)
     logging.info(f'Отправили музыку в чат {chat_id} по имени файла: {filename}')
 
-# Запуск polling для обработки сообщений от пользователей
-bot.polling(none_stop=True, timeout=30)
+#отправка по file_id без обращения к диску, False - если нужно загружать файл
+def send_cached_music(chat_id, url):
+    file_id = get_cached_file_id(url)
+    if not file_id:
+        count_event('file_id_miss')
+        return False
+    try:
+        with timed('send_file_id'):
+            bot.send_audio(chat_id, file_id)
+    except telebot.apihelper.ApiTelegramException as e:
+        logging.warning(f'Telegram отклонил file_id для {url}: {e}')
+        drop_cached_file_id(url)
+        count_event('file_id_rejected')
+        return False
+    count_event('file_id_hit')
+    logging.info(f'Отправили музыку в чат {chat_id} по file_id: {url}')
+    return True
+
+#обработчики проверяются по порядку: команды раньше обработчика любого текста
+def register_handlers():
+    bot.register_message_handler(start, commands=['start'])
+    bot.register_message_handler(handle_broadcast_command, commands=['broadcast'])
+    bot.register_message_handler(handle_broadcast_status_command, commands=['broadcast_status'])
+    bot.register_message_handler(handle_cache_stats_command, commands=['cachestats'])
+    bot.register_message_handler(handle_stats_command, commands=['stats'])
+    bot.register_message_handler(handle_profile_command, commands=['profile'])
+    bot.register_message_handler(text, content_types=['text'])
+    bot.register_callback_query_handler(query_outdated, func=lambda call: call.data.startswith(('page_', 'download_')))
+    bot.register_callback_query_handler(query_page, func=lambda call: call.data.startswith('p:'))
+    bot.register_callback_query_handler(callback_query, func=lambda call: call.data.startswith('d:'))
+
+#threaded=False - обработчики по очереди в потоке, который передал обновления, без пула потоков TeleBot
+def create_bot(token=BOT_TOKEN, threaded=True):
+    global bot
+    if BOT_API_URL:
+        telebot.apihelper.API_URL = BOT_API_URL + '/bot{0}/{1}'
+    bot = telebot.TeleBot(token, threaded=threaded)
+    register_handlers()
+    return bot
+
+##WEBHOOK
+#номер процесса-обработчика по ID чата
+def update_worker_index(update, workers=WEBHOOK_WORKERS):
+    for kind in ('message', 'edited_message', 'callback_query'):
+        if kind in update:
+            item = update[kind]
+            chat = (item.get('message') or item).get('chat') or item.get('from') or {}
+            return chat.get('id', 0) % workers
+    return update.get('update_id', 0) % workers
+
+#HTTP-сервер только принимает обновление и раскладывает по очередям процессов-обработчиков
+def make_webhook_handler(update_queues):
+    class WebhookHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if self.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET:
+                self.send_response(403)
+                self.end_headers()
+                return
+            body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+            try:
+                update = json.loads(body)
+            except ValueError:
+                self.send_response(400)
+                self.end_headers()
+                return
+            update_queues[update_worker_index(update)].put(body.decode('utf-8'))
+            self.send_response(200)
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            logging.debug('webhook: ' + format % args)
+    return WebhookHandler
+
+def webhook_worker(index, updates):
+    create_bot(threaded=False)  # Обработчики по очереди, чтобы сообщения чата обрабатывались в порядке прихода
+    start_db_writer()
+    start_download_workers()
+    if STATS_PORT:
+        start_stats_server(STATS_PORT + index)
+    if int(ADMIN_USER_ID) % WEBHOOK_WORKERS == index:  # Рассылки живут в процессе, куда приходят команды администратора
+        resume_broadcasts()
+    try:
+        while True:
+            update = updates.get()
+            if update is None:
+                return
+            try:
+                bot.process_new_updates([types.Update.de_json(update)])
+            except Exception as e:
+                logging.error(f'Ошибка обработки обновления в процессе {index}: {e}')
+    finally:
+        db_flush()  # atexit в дочерних процессах multiprocessing не вызывается
+        cache_flush()
+        # Иначе выход процесса ждет простаивающие процессы пула загрузок, а им никто не скажет завершиться.
+        # Только с ожиданием: при wait=False очередь уже закрыта, когда пулу отправляются сигналы остановки
+        download_pool.shutdown(cancel_futures=True)
+
+def run_webhook():
+    context = multiprocessing.get_context('fork')  # Процессы создаются до запуска любых потоков, бота каждый создает сам
+    update_queues = [context.Queue() for _ in range(WEBHOOK_WORKERS)]
+    workers = [context.Process(target=webhook_worker, args=(index, updates), name=f'refinder-worker-{index}')
+               for index, updates in enumerate(update_queues)]
+    for worker in workers:
+        worker.start()
+    create_bot(threaded=False)  # Этому процессу бот нужен только для set_webhook
+    start_cache_cleanup()
+    bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET)
+    server = ThreadingHTTPServer((WEBHOOK_HOST, WEBHOOK_PORT), make_webhook_handler(update_queues))
+    logging.info(f'Принимаем webhook на {WEBHOOK_HOST}:{WEBHOOK_PORT}, процессов-обработчиков: {WEBHOOK_WORKERS}')
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        for updates in update_queues:
+            updates.put(None)
+        for worker in workers:
+            worker.join()
+
+# Запуск: polling - все в одном процессе, webhook - HTTP-сервер и процессы-обработчики
+def main():
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))  # Чтобы при остановке сработал atexit и история дописалась
+    init_storage()
+    load_audio_store()
+    if BOT_MODE == 'webhook':
+        run_webhook()
+    else:
+        create_bot()
+        bot.remove_webhook()  # Пока установлен webhook, getUpdates не работает
+        start_db_writer()
+        start_cache_cleanup()
+        start_download_workers()
+        if STATS_PORT:
+            start_stats_server(STATS_PORT)
+        resume_broadcasts()
+        bot.polling(none_stop=True, timeout=30)
+
+
+if __name__ == '__main__':
+    main()